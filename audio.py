@@ -0,0 +1,56 @@
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from cancellation import Cancelled
+
+# Prefer sources our players take as-is, so the postprocessor can stream-copy
+REMUX_FORMAT = 'bestaudio[acodec^=mp4a]/bestaudio[acodec=opus]/bestaudio'
+
+# FFmpegExtractAudio with 'best' keeps the source codec and only rewraps it
+# (aac -> .m4a, opus -> .opus, vorbis -> .ogg) instead of re-encoding.
+REMUX_POSTPROCESSOR = {
+    'key': 'FFmpegExtractAudio',
+    'preferredcodec': 'best',
+}
+
+ENCODERS = {
+    'mp3': 'libmp3lame',
+}
+
+
+class Transcoder:
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 2
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='transcode')
+
+    def submit(self, source, codec='mp3', bitrate='192k', token=None):
+        return self.executor.submit(self._transcode, source, codec, bitrate, token)
+
+    def _transcode(self, source, codec, bitrate, token=None):
+        if token is not None:
+            token.raise_if_cancelled()
+        base, ext = os.path.splitext(source)
+        if ext.lstrip('.').lower() == codec:
+            return source
+        output = f"{base}.{codec}"
+        temp_output = f"{base}.tmp.{codec}"
+        # One thread per ffmpeg, parallelism comes from running several at once
+        cmd = ['ffmpeg', '-y', '-nostdin', '-loglevel', 'error', '-threads', '1',
+               '-i', source, '-vn', '-codec:a', ENCODERS[codec], '-b:a', bitrate, temp_output]
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if token is not None:
+            token.on_cancel(process.kill)
+        _, stderr = process.communicate()
+        if process.returncode != 0:
+            if os.path.exists(temp_output):
+                os.remove(temp_output)
+            # The downloaded source is kept, a resumed item only has to convert again
+            if token is not None and token.cancelled:
+                raise Cancelled(token.reason)
+            raise RuntimeError(f"ffmpeg failed: {stderr.strip()}")
+        os.replace(temp_output, output)
+        os.remove(source)
+        return output
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
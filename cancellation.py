@@ -0,0 +1,108 @@
+import threading
+import weakref
+from yt_dlp import YoutubeDL
+
+
+class Cancelled(Exception):
+    # Same wording the progress hooks have always used, existing handlers treat it as a pause
+    def __init__(self, reason='cancel'):
+        super().__init__(f"Download interrupted ({reason})")
+        self.reason = reason
+
+
+class CancelToken:
+    def __init__(self):
+        self.event = threading.Event()
+        self.reason = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def cancel(self, reason='cancel'):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.reason = reason
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Cancel callback failed: {e}")
+
+    def on_cancel(self, callback):
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def raise_if_cancelled(self):
+        if self.event.is_set():
+            raise Cancelled(self.reason)
+
+
+class CancelRegistry:
+    def __init__(self):
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def create(self, key):
+        token = CancelToken()
+        with self.lock:
+            self.tokens[key] = token
+        return token
+
+    def cancel(self, key, reason='cancel'):
+        with self.lock:
+            token = self.tokens.get(key)
+        if token:
+            token.cancel(reason)
+        return token is not None
+
+    def cancel_all(self, reason='cancel'):
+        with self.lock:
+            tokens = list(self.tokens.values())
+        for token in tokens:
+            token.cancel(reason)
+        return len(tokens)
+
+    def discard(self, key, token=None):
+        with self.lock:
+            if token is None or self.tokens.get(key) is token:
+                self.tokens.pop(key, None)
+
+
+class CancellableYoutubeDL(YoutubeDL):
+    # Tracks the responses the downloaders open so a cancel can close them
+    # right away instead of waiting for the next progress hook.
+    def __init__(self, params=None, token=None, **kwargs):
+        super().__init__(params, **kwargs)
+        self.cancel_token = token
+        # Weak so finished fragment responses don't pile up on long downloads
+        self.open_responses = weakref.WeakSet()
+        self.responses_lock = threading.Lock()
+        if token is not None:
+            token.on_cancel(self.abort_responses)
+
+    def urlopen(self, req):
+        if self.cancel_token is not None:
+            self.cancel_token.raise_if_cancelled()
+        response = super().urlopen(req)
+        with self.responses_lock:
+            self.open_responses.add(response)
+        return response
+
+    def abort_responses(self):
+        with self.responses_lock:
+            responses = list(self.open_responses)
+            self.open_responses = weakref.WeakSet()
+        for response in responses:
+            try:
+                response.close()
+            except Exception:
+                pass
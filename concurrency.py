@@ -0,0 +1,103 @@
+import threading
+import time
+from urllib.parse import urlparse
+
+
+def host_of(url):
+    return urlparse(url).netloc.lower() or 'unknown'
+
+
+class ConcurrencyController:
+    # AIMD: add a slot while throughput keeps scaling, halve on errors
+    def __init__(self, minimum, maximum, initial, gain=1.05, drop=0.8):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(minimum, min(maximum, initial))
+        self.gain = gain
+        self.drop = drop
+        self.window_bytes = 0
+        self.window_errors = 0
+        self.window_start = time.time()
+        self.last_throughput = None
+        self.throughput = 0
+
+    def evaluate(self, active, now):
+        elapsed = now - self.window_start
+        if elapsed <= 0:
+            return self.limit
+        throughput = self.window_bytes / elapsed
+        saturated = active >= self.limit
+        if self.window_errors:
+            self.limit = max(self.minimum, int(self.limit / 2))
+        elif saturated and (self.last_throughput is None or throughput >= self.last_throughput * self.gain):
+            self.limit = min(self.maximum, self.limit + 1)
+        elif saturated and self.last_throughput and throughput < self.last_throughput * self.drop:
+            self.limit = max(self.minimum, self.limit - 1)
+        # Idle windows say nothing about the link, keep the previous baseline
+        if active:
+            self.last_throughput = throughput
+        self.throughput = throughput
+        self.window_bytes = 0
+        self.window_errors = 0
+        self.window_start = now
+        return self.limit
+
+
+class AdaptiveConcurrency:
+    def __init__(self, minimum=1, maximum=8, initial=3, enabled=True):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.initial = initial
+        self.enabled = enabled
+        self.controllers = {}
+        self.last_bytes = {}
+        self.lock = threading.Lock()
+
+    def _controller(self, host):
+        if host not in self.controllers:
+            self.controllers[host] = ConcurrencyController(self.minimum, self.maximum, self.initial)
+        return self.controllers[host]
+
+    def limit(self, host):
+        if not self.enabled:
+            return self.initial
+        with self.lock:
+            return self._controller(host).limit
+
+    def record_progress(self, download_id, host, data):
+        # downloaded_bytes restarts for every file of a merged download
+        key = (download_id, data.get('tmpfilename'))
+        downloaded = data.get('downloaded_bytes') or 0
+        with self.lock:
+            previous = self.last_bytes.get(key, 0)
+            delta = downloaded - previous if downloaded >= previous else downloaded
+            self.last_bytes[key] = downloaded
+            self._controller(host).window_bytes += delta
+
+    def record_error(self, host):
+        with self.lock:
+            self._controller(host).window_errors += 1
+
+    def forget(self, download_id):
+        with self.lock:
+            for key in [key for key in self.last_bytes if key[0] == download_id]:
+                del self.last_bytes[key]
+
+    def evaluate(self, active_by_host, now=None):
+        now = now or time.time()
+        changed = False
+        with self.lock:
+            for host, controller in self.controllers.items():
+                previous = controller.limit
+                if self.enabled:
+                    controller.evaluate(active_by_host.get(host, 0), now)
+                changed = changed or controller.limit > previous
+        return changed
+
+    def describe(self):
+        with self.lock:
+            if not self.enabled or not self.controllers:
+                return f"Concurrency: {self.initial}"
+            parts = [f"{controller.limit} @ {controller.throughput / (1024 * 1024):.1f}MB/s"
+                     for controller in self.controllers.values()]
+        return "Concurrency: " + ", ".join(parts)
@@ -0,0 +1,64 @@
+import json
+import os
+import tempfile
+
+SETTINGS_FILE = 'settings.json'
+DEFAULT_SETTINGS = {
+    'metadata_workers': 0,  # 0 = one worker process per CPU core
+    'ydl_pool_max_idle': 4,
+    'ydl_pool_max_uses': 100,
+    'ydl_pool_max_age': 900,  # seconds before an instance is recycled
+    'staged_writes': True,  # download into a staging folder, then fsync + rename
+    'preallocate': True,
+    'download_buffer_size': 1024 * 1024,
+    'http_chunk_size': 10 * 1024 * 1024,
+    'scheduling_policy': 'FIFO',
+    'off_peak_enabled': False,  # hold large items until the off-peak window
+    'off_peak_start_hour': 1,
+    'off_peak_end_hour': 7,
+    'off_peak_min_bytes': 1024 * 1024 * 1024,
+    'max_concurrent_downloads': 3,  # fixed limit, or the starting point when adaptive
+    'adaptive_concurrency': True,
+    'adaptive_min_downloads': 1,
+    'adaptive_max_downloads': 8,
+    'adaptive_interval': 10,  # seconds between concurrency adjustments
+    'transcode_workers': 0,  # 0 = one ffmpeg process per CPU core
+    'mp3_bitrate': '192k',
+    'stream_cache_enabled': True,  # route previews through a caching proxy downloads can reuse
+    'stream_cache_dir': os.path.join(tempfile.gettempdir(), 'ytdl-stream-cache'),
+    'stream_cache_max_bytes': 2 * 1024 * 1024 * 1024,
+    'shared_queue_path': None,  # SQLite file shared with worker.py processes
+    'shared_queue_lease': 60,  # seconds a worker owns an item without a heartbeat
+    'shared_queue_wal': True,  # set False when workers on other hosts use a network share
+    'shared_queue_poll': 2,
+    'disk_space_margin': 512 * 1024 * 1024,  # always keep this much free on a destination
+    'disk_space_unknown_size': 1024 * 1024 * 1024,  # reserved for items without a size estimate
+    'lookahead_depth': 3,  # queued items resolved ahead of a free slot
+    'lookahead_workers': 2,
+    'lookahead_ttl': 1800,
+    'shutdown_timeout': 5,  # seconds to wait for downloads to stop when closing
+    'video_info_cache_entries': 64,
+    'video_info_cache_bytes': 16 * 1024 * 1024,
+    'memory_report_interval': 0,  # seconds between memory reports on the console, 0 disables
+    'memory_debug': False,  # adds the Debug menu with tracemalloc snapshots
+    'tracemalloc_frames': 25,
+    # Concurrent downloads writing to one disk, 0 for no limit. Applied on top of the
+    # per-host limit from max_concurrent_downloads / adaptive concurrency: an item
+    # starts only when both have room, so a value below adaptive_max_downloads caps
+    # the adaptive controller for downloads to that disk. Best set per slow disk in
+    # io_device_limits rather than globally.
+    'io_writers_per_device': 0,
+    'io_merges_per_device': 1,  # concurrent ffmpeg merges and conversions on one disk
+    'io_device_limits': {},  # per-disk overrides, e.g. {"/mnt/archive": {"writers": 1}}
+    'io_throughput_window': 10,  # seconds of progress averaged for per-disk throughput
+}
+
+
+def load_settings():
+    settings = dict(DEFAULT_SETTINGS)
+    try:
+        with open(SETTINGS_FILE, 'r') as f:
+            settings.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    return settings
@@ -0,0 +1,113 @@
+import os
+import shutil
+import threading
+
+
+def existing_parent(path):
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def device_of(location):
+    return os.stat(existing_parent(location)).st_dev
+
+
+class DiskReservations:
+    # Tracks predicted bytes of running downloads per device, so new items are
+    # only admitted while free space covers everything already in flight.
+    # shared: optional object with reserve(download_id, device, needed, available),
+    # update(download_id, outstanding) and release(download_id), for processes
+    # writing to the same disks; it then decides admission instead of this process.
+    def __init__(self, margin_bytes=512 * 1024 * 1024, unknown_bytes=1024 * 1024 * 1024, shared=None):
+        self.margin_bytes = margin_bytes
+        self.unknown_bytes = unknown_bytes
+        self.shared = shared
+        self.reservations = {}
+        self.lock = threading.Lock()
+
+    def _outstanding(self, reservation):
+        # Bytes already written or preallocated show up in free space, don't
+        # count them twice. Headroom for merging or converting stays reserved
+        # until release.
+        files = set(reservation['written']) | set(reservation['preallocated'])
+        consumed = sum(max(reservation['written'].get(path, 0), reservation['preallocated'].get(path, 0))
+                       for path in files)
+        return max(reservation['needed'] - min(consumed, reservation['predicted']), 0)
+
+    def try_reserve(self, download_id, location, predicted_bytes, factor=1.0):
+        path = existing_parent(location)
+        device = os.stat(path).st_dev
+        predicted = predicted_bytes or self.unknown_bytes
+        needed = int(predicted * factor)
+        free = shutil.disk_usage(path).free
+        with self.lock:
+            if download_id in self.reservations:
+                return True
+            if self.shared is None:
+                reserved = sum(self._outstanding(reservation) for reservation in self.reservations.values()
+                               if reservation['device'] == device)
+                if free - reserved - needed < self.margin_bytes:
+                    return False
+        # Outside the lock, the shared side may wait on other processes and
+        # progress hooks of running downloads shouldn't wait with it
+        if self.shared is not None and not self.shared.reserve(download_id, device, needed,
+                                                                free - self.margin_bytes):
+            return False
+        with self.lock:
+            self.reservations[download_id] = {
+                'device': device,
+                'predicted': predicted,
+                'needed': needed,
+                'written': {},
+                'preallocated': {},
+            }
+        return True
+
+    def record_written(self, download_id, data):
+        with self.lock:
+            reservation = self.reservations.get(download_id)
+            if reservation is not None:
+                key = data.get('tmpfilename') or data.get('filename')
+                reservation['written'][key] = data.get('downloaded_bytes') or 0
+
+    def record_preallocated(self, download_id, path, size):
+        # fallocate takes the whole size out of free space before any byte is written
+        with self.lock:
+            reservation = self.reservations.get(download_id)
+            if reservation is not None:
+                reservation['preallocated'][path] = size
+
+    def publish(self, download_id):
+        # Progress hooks fire too often to write each one to the shared side,
+        # the remaining bytes are pushed from here instead, e.g. on heartbeats
+        if self.shared is None:
+            return
+        with self.lock:
+            reservation = self.reservations.get(download_id)
+            outstanding = self._outstanding(reservation) if reservation else None
+        if outstanding is not None:
+            self.shared.update(download_id, outstanding)
+
+    def release(self, download_id):
+        with self.lock:
+            reservation = self.reservations.pop(download_id, None)
+        if reservation is not None and self.shared is not None:
+            self.shared.release(download_id)
+
+    def reserved_bytes(self, location):
+        device = device_of(location)
+        with self.lock:
+            return sum(self._outstanding(reservation) for reservation in self.reservations.values()
+                       if reservation['device'] == device)
+
+
+def space_factor(options, ffmpeg_available):
+    # Merges and MP3 conversion keep the source next to the output for a while
+    if ffmpeg_available and options['format'] in ("video", "audio"):
+        return 2.0
+    return 1.1
@@ -0,0 +1,146 @@
+import time
+from yt_dlp.networking.exceptions import HTTPError, TransportError
+from yt_dlp.utils import download_range_func
+from cancellation import CancellableYoutubeDL
+import write_path
+import integrity
+from audio import REMUX_FORMAT, REMUX_POSTPROCESSOR
+
+# Format selection and the write/finish steps shared by the GUI and worker.py
+
+
+def format_timestamp(seconds):
+    seconds = int(seconds)
+    h, m, s = seconds // 3600, (seconds % 3600) // 60, seconds % 60
+    return f"{h}:{m:02d}:{s:02d}" if h else f"{m}:{s:02d}"
+
+
+def video_format(quality, ffmpeg_available):
+    if ffmpeg_available:
+        if quality == "highest":
+            return 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]'
+        if quality == "lowest":
+            return 'worstvideo[ext=mp4]+worstaudio[ext=m4a]/worst[ext=mp4]'
+        height = quality[:-1]
+        return f'bestvideo[height<={height}][ext=mp4]+bestaudio[ext=m4a]/best[height<={height}][ext=mp4]'
+    if quality == "highest":
+        return 'best[ext=mp4]'
+    if quality == "lowest":
+        return 'worst[ext=mp4]'
+    height = quality[:-1]
+    return f'best[height<={height}][ext=mp4]'
+
+
+def audio_format(format_type, ffmpeg_available):
+    if format_type == "audio_original":
+        return REMUX_FORMAT if ffmpeg_available else 'bestaudio[ext=m4a]/bestaudio'
+    # MP3 is encoded from whatever audio stream is best
+    return 'bestaudio' if ffmpeg_available else 'bestaudio[ext=m4a]'
+
+
+def preview_format(stream_type, options, ffmpeg_available):
+    # Picks what the download would pick wherever that is a single stream, so
+    # bytes fetched by the preview can be reused by the download
+    if stream_type == "audio":
+        format_type = options['format'] if options['format'] != "video" else "audio"
+        return audio_format(format_type, ffmpeg_available)
+    # VLC plays one URL, merged video downloads can't share the preview bytes
+    return video_format(options['quality'], False) + '/best'
+
+
+def is_single_stream(selector):
+    return '+' not in selector
+
+
+def build_ydl_opts(options, write_dir, progress_hooks, settings, ffmpeg_available):
+    clip = options.get('clip')
+    name_template = "%(title)s"
+    if clip:
+        name_template += f" [{format_timestamp(clip['start'])}-{format_timestamp(clip['end'])}]".replace(':', '.')
+
+    ydl_opts = {
+        'outtmpl': f"{write_dir}/{name_template}.%(ext)s",
+        'progress_hooks': progress_hooks,
+        'noplaylist': True,
+        'socket_timeout': 15,
+    }
+    ydl_opts.update(write_path.build_write_opts(settings['download_buffer_size'],
+                                                settings['http_chunk_size']))
+    if clip:
+        # Only the requested section is fetched; exact cuts re-encode around keyframes.
+        # Ranges go through yt-dlp's ffmpeg downloader, which runs the section in one
+        # ffmpeg call with no progress hooks and no handle for closing its
+        # connection, so a pause or remove only takes effect once ffmpeg exits.
+        ydl_opts['download_ranges'] = download_range_func(None, [(clip['start'], clip['end'])])
+        ydl_opts['force_keyframes_at_cuts'] = clip.get('accurate', False)
+
+    format_type = options['format']
+    if format_type == "video":
+        ydl_opts['format'] = video_format(options['quality'], ffmpeg_available)
+    else:
+        # MP3 encoding runs in the transcoder pool after the bytes are in,
+        # so the download slot is free while ffmpeg works
+        ydl_opts['format'] = audio_format(format_type, ffmpeg_available)
+        if format_type == "audio_original" and ffmpeg_available:
+            ydl_opts['postprocessors'] = [REMUX_POSTPROCESSOR]
+    return ydl_opts
+
+
+def needs_transcode(options, ffmpeg_available):
+    return options['format'] == "audio" and ffmpeg_available
+
+
+def is_network_error(error):
+    # Connection failures and throttling answers from the host, found through
+    # the DownloadError/ExtractorError wrappers yt-dlp puts around them
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, HTTPError):
+            return error.status in (403, 429) or error.status >= 500
+        if isinstance(error, (TransportError, ConnectionError, TimeoutError)):
+            return True
+        exc_info = getattr(error, 'exc_info', None)
+        error = ((exc_info[1] if exc_info else None) or getattr(error, 'cause', None)
+                 or error.__cause__ or error.__context__)
+    return False
+
+
+def run_ydl(url, ydl_opts, max_retries=3, on_error=None, prefetched=None, token=None):
+    # on_error is told about network errors only, a missing format or an
+    # ffmpeg failure says nothing about how the host is coping
+    # prefetched: unprocessed info from the look-ahead resolver, used for the first attempt only
+    for attempt in range(max_retries):
+        try:
+            if token is not None:
+                token.raise_if_cancelled()
+            with CancellableYoutubeDL(ydl_opts, token=token) as ydl:
+                if prefetched and attempt == 0:
+                    info = ydl.process_ie_result(prefetched, download=True)
+                else:
+                    info = ydl.extract_info(url, download=True)
+                requested = info.get('requested_downloads') or [{}]
+                output_file = requested[0].get('filepath') or ydl.prepare_filename(info)
+            return output_file, info
+        except Exception as e:
+            # A cancel closes the open responses, the errors that follow aren't the host's fault
+            cancelled = "Download interrupted" in str(e) or (token is not None and token.cancelled)
+            if on_error and not cancelled and is_network_error(e):
+                on_error(e)
+            if attempt < max_retries - 1 and "Download interrupted" not in str(e):
+                print(f"Retry {attempt + 1}/{max_retries} for download: {e}")
+                time.sleep(2)
+                continue
+            raise
+
+
+def finish_download(output_file, location, hasher, format_type, staged):
+    # Merged and converted files are new on disk, those get hashed once here
+    digest = hasher.digest(output_file)
+    if staged:
+        output_file = write_path.finalize(output_file, location)
+    entry = integrity.record(output_file, digest, format=format_type)
+    return output_file, {
+        'size': entry['size'],
+        integrity.HASH_ALGORITHM: entry[integrity.HASH_ALGORITHM],
+    }
@@ -0,0 +1,200 @@
+import argparse
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+
+if os.name == 'posix':
+    import fcntl
+else:
+    import msvcrt
+
+MANIFEST_NAME = '.manifest.json'
+LOCK_NAME = '.manifest.lock'
+HASH_ALGORITHM = 'sha256'
+READ_SIZE = 1024 * 1024
+
+
+def hash_file(path):
+    hasher = hashlib.new(HASH_ALGORITHM)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class StreamingHasher:
+    # Follows yt-dlp's .part files from the progress hooks and hashes bytes as
+    # they land, while they are still in the page cache.
+    def __init__(self):
+        self.files = {}
+
+    def _catch_up(self, path, limit=None):
+        state = self.files.setdefault(path, [hashlib.new(HASH_ALGORITHM), 0])
+        hasher, offset = state
+        try:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                while limit is None or offset < limit:
+                    size = READ_SIZE if limit is None else min(READ_SIZE, limit - offset)
+                    chunk = f.read(size)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    offset += len(chunk)
+        except FileNotFoundError:
+            pass
+        state[1] = offset
+
+    def on_progress(self, data):
+        if data.get('status') == 'downloading' and data.get('tmpfilename'):
+            # The writer may still buffer the newest bytes, anything short is read next time
+            self._catch_up(data['tmpfilename'], data.get('downloaded_bytes'))
+        elif data.get('status') == 'finished' and data.get('filename'):
+            filename = data['filename']
+            part_name = filename + '.part'
+            if part_name in self.files:
+                self.files[filename] = self.files.pop(part_name)
+            self._catch_up(filename)
+
+    def digest(self, path):
+        state = self.files.get(path)
+        if state is None or not os.path.exists(path) or state[1] != os.path.getsize(path):
+            return None
+        return state[0].hexdigest()
+
+
+def manifest_path(folder):
+    return os.path.join(folder, MANIFEST_NAME)
+
+
+def load_manifest(folder):
+    try:
+        with open(manifest_path(folder), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+@contextmanager
+def manifest_lock(folder):
+    # A file lock, the GUI, worker.py processes and the verify command may all
+    # update the same folder. Only held to read, merge and replace the manifest.
+    with open(os.path.join(folder, LOCK_NAME), 'a+b') as f:
+        if os.name == 'posix':
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    # Retries for about 10 seconds before giving up with OSError
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        try:
+            yield
+        finally:
+            if os.name == 'posix':
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def save_manifest(folder, manifest):
+    path = manifest_path(folder)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(temp_path, path)
+
+
+def record(path, digest=None, format=None):
+    stat = os.stat(path)
+    entry = {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        HASH_ALGORITHM: digest or hash_file(path),
+        'format': format,
+    }
+    folder, name = os.path.split(os.path.abspath(path))
+    with manifest_lock(folder):
+        manifest = load_manifest(folder)
+        manifest[name] = entry
+        save_manifest(folder, manifest)
+    return entry
+
+
+def verify_folder(folder, full=False):
+    # Size and mtime decide what needs re-hashing unless full is set
+    # Hashing runs without the lock, downloads finishing meanwhile aren't held up
+    result = {'ok': [], 'rehashed': [], 'corrupt': [], 'missing': []}
+    manifest = load_manifest(folder)
+    touched = {}
+    for name, entry in manifest.items():
+        path = os.path.join(folder, name)
+        if not os.path.exists(path):
+            result['missing'].append(name)
+            continue
+        stat = os.stat(path)
+        suspect = stat.st_size != entry['size'] or stat.st_mtime != entry['mtime']
+        if not suspect and not full:
+            result['ok'].append(name)
+            continue
+        if stat.st_size == entry['size'] and hash_file(path) == entry[HASH_ALGORITHM]:
+            result['rehashed'].append(name)
+            if entry['mtime'] != stat.st_mtime:
+                touched[name] = stat.st_mtime
+        else:
+            result['corrupt'].append(name)
+    if touched:
+        with manifest_lock(folder):
+            current = load_manifest(folder)
+            for name, mtime in touched.items():
+                # Skip entries a download rewrote while we were hashing
+                entry = current.get(name)
+                if entry and entry[HASH_ALGORITHM] == manifest[name][HASH_ALGORITHM]:
+                    entry['mtime'] = mtime
+            save_manifest(folder, current)
+    return result
+
+
+def find_duplicates(folders):
+    # Uses manifest hashes only, nothing is read back from disk
+    groups = {}
+    for folder in folders:
+        for name, entry in load_manifest(folder).items():
+            key = (entry['size'], entry[HASH_ALGORITHM])
+            groups.setdefault(key, []).append(os.path.join(folder, name))
+    return [paths for paths in groups.values() if len(paths) > 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify downloads against their folder manifests")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    verify_parser = subparsers.add_parser('verify')
+    verify_parser.add_argument('folders', nargs='+')
+    verify_parser.add_argument('--full', action='store_true', help="re-hash every file, not only suspect ones")
+    duplicates_parser = subparsers.add_parser('duplicates')
+    duplicates_parser.add_argument('folders', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'verify':
+        failed = False
+        for folder in args.folders:
+            result = verify_folder(folder, full=args.full)
+            print(f"{folder}: {len(result['ok'])} ok, {len(result['rehashed'])} re-hashed ok, "
+                  f"{len(result['corrupt'])} corrupt, {len(result['missing'])} missing")
+            for name in result['corrupt']:
+                print(f"  corrupt: {name}")
+            for name in result['missing']:
+                print(f"  missing: {name}")
+            failed = failed or bool(result['corrupt'] or result['missing'])
+        return 1 if failed else 0
+    for paths in find_duplicates(args.folders):
+        print("duplicates:\n  " + "\n  ".join(paths))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
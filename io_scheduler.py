@@ -0,0 +1,182 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from disk_space import device_of, existing_parent
+
+# yt-dlp postprocessors that read and rewrite the whole file on the destination
+MERGE_POSTPROCESSORS = {'FFmpegMerger', 'FFmpegExtractAudio', 'FFmpegVideoConvertor',
+                        'FFmpegVideoRemuxer', 'FFmpegFixupM4a', 'FFmpegFixupStretched'}
+
+
+class DeviceState:
+    def __init__(self, path, max_writers, max_merges):
+        self.path = path
+        self.max_writers = max_writers
+        self.max_merges = max_merges
+        self.writers = set()
+        self.merges = 0
+        self.merge_freed = threading.Condition()
+        self.samples = deque()
+        self.total_bytes = 0
+
+
+class IOScheduler:
+    # Groups downloads by the device they write to, so one slow volume can't
+    # hold every slot while items for other volumes wait in the queue. The
+    # writer limit is checked in addition to the per-host concurrency limit,
+    # whichever is tighter wins; 0 means no limit.
+    def __init__(self, max_writers=0, max_merges=1, device_limits=None, window=10):
+        self.max_writers = max_writers
+        self.max_merges = max_merges
+        # {path: {'writers': n, 'merges': n}}, paths because device numbers change between boots
+        self.device_limits = device_limits or {}
+        self.window = window
+        self.devices = {}
+        self.owners = {}
+        self.written = {}
+        self.lock = threading.Lock()
+
+    def _limits_for(self, device):
+        limits = {}
+        for path, overrides in self.device_limits.items():
+            try:
+                if device_of(path) == device:
+                    limits = overrides
+                    break
+            except OSError:
+                continue
+        return limits.get('writers', self.max_writers), limits.get('merges', self.max_merges)
+
+    def device(self, location):
+        device = device_of(location)
+        with self.lock:
+            if device not in self.devices:
+                max_writers, max_merges = self._limits_for(device)
+                self.devices[device] = DeviceState(existing_parent(location), max_writers, max_merges)
+        return device
+
+    def can_start(self, location):
+        device = self.device(location)
+        with self.lock:
+            state = self.devices[device]
+            return not state.max_writers or len(state.writers) < state.max_writers
+
+    def start_writing(self, download_id, location):
+        # Admission is checked with can_start, a manual start may go over the limit
+        device = self.device(location)
+        with self.lock:
+            self.devices[device].writers.add(download_id)
+            self.owners[download_id] = device
+
+    def finish_writing(self, download_id):
+        # Called once the bytes are in, a following conversion is gated by merge_slot
+        with self.lock:
+            device = self.owners.pop(download_id, None)
+            if device is not None:
+                self.devices[device].writers.discard(download_id)
+            for key in [key for key in self.written if key[0] == download_id]:
+                del self.written[key]
+
+    def record_progress(self, download_id, data):
+        if data.get('status') != 'downloading':
+            return
+        key = (download_id, data.get('tmpfilename') or data.get('filename'))
+        downloaded = data.get('downloaded_bytes') or 0
+        now = time.monotonic()
+        with self.lock:
+            device = self.owners.get(download_id)
+            if device is None:
+                return
+            # Fragments and resumed downloads can report smaller counts, only growth is written bytes
+            delta = max(downloaded - self.written.get(key, 0), 0)
+            self.written[key] = downloaded
+            state = self.devices[device]
+            state.total_bytes += delta
+            state.samples.append((now, delta))
+            self._expire(state, now)
+
+    def _expire(self, state, now):
+        while state.samples and state.samples[0][0] < now - self.window:
+            state.samples.popleft()
+
+    def throughput(self, location):
+        device = self.device(location)
+        with self.lock:
+            state = self.devices[device]
+            self._expire(state, time.monotonic())
+            return sum(delta for _, delta in state.samples) / self.window
+
+    @contextmanager
+    def merge_slot(self, location, token=None):
+        state = self.devices[self.device(location)]
+        with state.merge_freed:
+            while state.max_merges and state.merges >= state.max_merges:
+                # Wake up regularly so a cancelled download doesn't wait for someone else's merge
+                state.merge_freed.wait(0.5)
+                if token is not None:
+                    token.raise_if_cancelled()
+            state.merges += 1
+        try:
+            yield
+        finally:
+            with state.merge_freed:
+                state.merges -= 1
+                state.merge_freed.notify()
+
+    def merge_gate(self, location, token=None):
+        return MergeGate(self, location, token)
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            result = []
+            for state in self.devices.values():
+                self._expire(state, now)
+                result.append({
+                    'path': state.path,
+                    'writers': len(state.writers),
+                    'max_writers': state.max_writers,
+                    'merges': state.merges,
+                    'max_merges': state.max_merges,
+                    'bytes_per_second': sum(delta for _, delta in state.samples) / self.window,
+                    'total_bytes': state.total_bytes,
+                })
+        return result
+
+    def describe(self):
+        busy = [device for device in self.stats() if device['writers'] or device['merges']]
+        if not busy:
+            return "Disks: idle"
+        parts = [f"{os.path.basename(device['path'].rstrip(os.sep)) or device['path']} "
+                 f"{device['writers']}/{device['max_writers'] or '-'} "
+                 f"@ {device['bytes_per_second'] / (1024 * 1024):.1f}MB/s"
+                 for device in busy]
+        return "Disks: " + ", ".join(parts)
+
+
+class MergeGate:
+    # postprocessor_hooks entry for one download: holds the device merge slot
+    # from a merging postprocessor's 'started' to its 'finished' event.
+    def __init__(self, scheduler, location, token=None):
+        self.scheduler = scheduler
+        self.location = location
+        self.token = token
+        self.slot = None
+
+    def on_postprocessor(self, data):
+        if data.get('postprocessor') not in MERGE_POSTPROCESSORS:
+            return
+        if data['status'] == 'started' and self.slot is None:
+            slot = self.scheduler.merge_slot(self.location, self.token)
+            slot.__enter__()
+            self.slot = slot
+        elif data['status'] == 'finished':
+            self.close()
+
+    def close(self):
+        # Postprocessors that raise never report 'finished'
+        if self.slot is not None:
+            slot, self.slot = self.slot, None
+            slot.__exit__(None, None, None)
@@ -0,0 +1,77 @@
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+_EXPIRE_RE = re.compile(r'[?&/]expire[=/](\d+)')
+
+EXTRACT_OPTS = {
+    'noplaylist': True,
+    'quiet': True,
+    'socket_timeout': 15,
+}
+
+
+def url_expiry(info):
+    # Stream URLs carry their own expiry, the earliest one bounds the whole entry
+    expiries = [int(match.group(1)) for fmt in info.get('formats') or []
+                for match in [_EXPIRE_RE.search(fmt.get('url') or '')] if match]
+    return min(expiries) if expiries else None
+
+
+class LookaheadResolver:
+    # Extracts metadata for the next few queued items while the current ones
+    # download, so a freed slot can go straight to moving bytes.
+    def __init__(self, ydl_pool, depth=3, workers=2, ttl=1800, refresh_margin=300):
+        self.ydl_pool = ydl_pool
+        self.depth = depth
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.entries = {}
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='lookahead')
+
+    def _fresh(self, entry, now, margin=0):
+        return entry is not None and entry[1] - margin > now
+
+    def prefetch(self, urls):
+        now = time.time()
+        wanted = list(dict.fromkeys(urls))[:self.depth]
+        with self.lock:
+            # Only the current window is kept, items further back are resolved when they get close
+            for url in list(self.entries):
+                if url not in wanted:
+                    del self.entries[url]
+            todo = [url for url in wanted if url not in self.pending
+                    and not self._fresh(self.entries.get(url), now, self.refresh_margin)]
+            self.pending.update(todo)
+        for url in todo:
+            self.executor.submit(self._resolve, url)
+
+    def _resolve(self, url):
+        try:
+            with self.ydl_pool.session(EXTRACT_OPTS) as ydl:
+                # process=False skips format selection, the download does that itself
+                info = ydl.extract_info(url, download=False, process=False)
+            expires = time.time() + self.ttl
+            url_expires = url_expiry(info)
+            if url_expires:
+                expires = min(expires, url_expires)
+            with self.lock:
+                self.entries[url] = (info, expires)
+        except Exception as e:
+            print(f"Look-ahead failed for {url}: {e}")
+        finally:
+            with self.lock:
+                self.pending.discard(url)
+
+    def take(self, url):
+        with self.lock:
+            entry = self.entries.pop(url, None)
+        if self._fresh(entry, time.time(), 30):
+            return entry[0]
+        return None
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
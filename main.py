@@ -4,17 +4,42 @@ import threading
 import os
 import json
 import time
+import copy
 from pathlib import Path
 import customtkinter as ctk
 from PIL import Image
 import requests
 from io import BytesIO
 from collections import deque
-import re
-from urllib.parse import urlparse, parse_qs
 from yt_dlp import YoutubeDL
 import shutil
+import multiprocessing
+import argparse
 import vlc
+from metadata_pool import MetadataResolver, compact_record, load_record
+from ydl_pool import YoutubeDLPool
+import write_path
+from scheduling import Scheduler, POLICIES, PRIORITIES
+from concurrency import AdaptiveConcurrency, host_of
+from audio import Transcoder
+from stream_cache import SegmentCache, CachingProxy, cache_key
+import youtube_urls
+import integrity
+import downloader
+from queue_store import QueueStore
+from disk_space import DiskReservations, space_factor
+from lookahead import LookaheadResolver
+from cancellation import CancelRegistry
+from memory import BoundedCache, MemoryMonitor, count_widgets
+from io_scheduler import IOScheduler
+from config import load_settings
+
+# Created in main(), not on import: spawned pool workers import this file as
+# __mp_main__ and must not load settings, open the shared queue or save state
+settings = None
+# Long-lived YoutubeDL instances shared by metadata, size and stream URL lookups
+ydl_pool = None
+download_manager = None
 
 # Global download manager
 class DownloadManager:
@@ -22,12 +47,28 @@ class DownloadManager:
         self.active_downloads = {}
         self.download_queue = deque()
         self.download_history = []
+        self.scheduler = Scheduler.from_settings(settings)
+        # With a shared queue, worker.py processes download and this app only observes
+        self.shared_store = None
+        self.shared_items = []
+        self.shared_history = []
+        if settings['shared_queue_path']:
+            self.shared_store = QueueStore(settings['shared_queue_path'],
+                                           lease_seconds=settings['shared_queue_lease'],
+                                           wal=settings['shared_queue_wal'])
         self.load_state()
+        self.publish_policy()
+    
+    def publish_policy(self):
+        # Workers read the policy from the store on every claim
+        if self.shared_store:
+            self.shared_store.set_meta('policy', self.scheduler.policy.name)
         
     def save_state(self):
         state = {
             'queue': list(self.download_queue),
-            'history': self.download_history[-50:]  # Keep last 50 items
+            'history': self.download_history[-50:],  # Keep last 50 items
+            'policy': self.scheduler.policy.name
         }
         with open('download_state.json', 'w') as f:
             json.dump(state, f)
@@ -38,22 +79,68 @@ class DownloadManager:
                 state = json.load(f)
                 self.download_queue = deque(state.get('queue', []))
                 self.download_history = state.get('history', [])
+                if state.get('policy') in POLICIES:
+                    self.scheduler.set_policy(state['policy'])
         except FileNotFoundError:
             pass
     
-    def add_download(self, url, options, title=None):
+    def add_download(self, url, options, title=None, estimated_bytes=None):
         download_id = f"{url}_{time.time()}"
+        if self.shared_store:
+            self.shared_store.add(download_id, url, options, title, estimated_bytes)
+            self.refresh_shared()
+            return download_id
         self.download_queue.append({
             'id': download_id,
             'url': url,
             'options': options,
             'status': 'queued',
             'progress': 0,
-            'title': title
+            'title': title,
+            'estimated_bytes': estimated_bytes
         })
         self.save_state()
         return download_id
     
+    def add_downloads(self, entries):
+        # Bulk variant of add_download, saves state once for the whole batch
+        download_ids = []
+        for url, options, title, estimated_bytes in entries:
+            download_id = f"{url}_{time.time()}"
+            if self.shared_store:
+                download_ids.append(self.shared_store.add(download_id, url, options, title, estimated_bytes))
+                continue
+            self.download_queue.append({
+                'id': download_id,
+                'url': url,
+                'options': dict(options),
+                'status': 'queued',
+                'progress': 0,
+                'title': title,
+                'estimated_bytes': estimated_bytes
+            })
+            download_ids.append(download_id)
+        if self.shared_store:
+            self.refresh_shared()
+            return download_ids
+        self.save_state()
+        return download_ids
+    
+    def set_estimated_bytes(self, download_id, estimated_bytes):
+        if self.shared_store and self.shared_store.set_estimated_bytes(download_id, estimated_bytes):
+            self.refresh_shared()
+            return True
+        for item in list(self.download_queue) + list(self.active_downloads.values()):
+            if item['id'] == download_id:
+                item['estimated_bytes'] = estimated_bytes
+                self.save_state()
+                return True
+        return False
+    
+    def next_downloads(self, count=None):
+        order = self.scheduler.order(self.download_queue)
+        return order if count is None else order[:max(count, 0)]
+    
     def start_download(self, download_id):
         for item in list(self.download_queue):
             if item['id'] == download_id:
@@ -65,13 +152,21 @@ class DownloadManager:
         return None
     
     def pause_download(self, download_id):
-        if download_id in self.active_downloads:
-            self.active_downloads[download_id]['status'] = 'paused'
-            self.download_queue.appendleft(self.active_downloads[download_id])
+        return bool(self.pause_downloads([download_id]))
+    
+    def pause_downloads(self, download_ids):
+        paused = []
+        for download_id in download_ids:
+            item = self.active_downloads.get(download_id)
+            if item is None:
+                continue
+            item['status'] = 'paused'
+            self.download_queue.appendleft(item)
             del self.active_downloads[download_id]
+            paused.append(download_id)
+        if paused:
             self.save_state()
-            return True
-        return False
+        return paused
     
     def resume_download(self, download_id):
         for item in list(self.download_queue):
@@ -81,11 +176,12 @@ class DownloadManager:
                 return self.start_download(download_id)
         return None
     
-    def complete_download(self, download_id, file_path):
+    def complete_download(self, download_id, file_path, details=None):
         if download_id in self.active_downloads:
             item = self.active_downloads[download_id]
             item['status'] = 'completed'
             item['file_path'] = file_path
+            item.update(details or {})
             item['completed_at'] = time.time()
             self.download_history.append(item)
             del self.active_downloads[download_id]
@@ -93,7 +189,16 @@ class DownloadManager:
             return True
         return False
     
+    def refresh_shared(self):
+        if self.shared_store:
+            self.shared_items = self.shared_store.items(['downloading', 'converting', 'queued', 'error'])
+            self.shared_history = self.shared_store.items(['completed'], limit=50)
+    
     def remove_download(self, download_id):
+        # A worker holding the item notices on its next heartbeat and stops
+        if self.shared_store and self.shared_store.remove(download_id):
+            self.refresh_shared()
+            return True
         if download_id in self.active_downloads:
             del self.active_downloads[download_id]
             self.save_state()
@@ -105,9 +210,6 @@ class DownloadManager:
                 return True
         return False
 
-# Global download manager instance
-download_manager = DownloadManager()
-
 class YouTubeDownloader:
     def __init__(self, root):
         self.root = root
@@ -136,13 +238,58 @@ class YouTubeDownloader:
         self.size_toggle_var = ctk.BooleanVar(value=False)
         self.size_fetching = False
         self.size_loading_label = None
-        self.video_info_cache = {}
+        # Compact records only, full info dicts are several hundred KB each
+        self.video_info_cache = BoundedCache(max_entries=settings['video_info_cache_entries'],
+                                             max_bytes=settings['video_info_cache_bytes'])
+        self.metadata_resolver = MetadataResolver(workers=settings['metadata_workers'] or None)
         self.current_url = None
         self.main_frame = None
+        self.queue_running = False
+        self.shared_refresh_pending = False
+        self.space_held = 0
+        self.io_held = 0
+        self.io = IOScheduler(max_writers=settings['io_writers_per_device'],
+                              max_merges=settings['io_merges_per_device'],
+                              device_limits=settings['io_device_limits'],
+                              window=settings['io_throughput_window'])
+        self.disk_reservations = DiskReservations(margin_bytes=settings['disk_space_margin'],
+                                                  unknown_bytes=settings['disk_space_unknown_size'])
+        self.cancellation = CancelRegistry()
+        self.download_threads = {}
+        self.closing = False
+        self.lookahead = LookaheadResolver(ydl_pool, depth=settings['lookahead_depth'],
+                                           workers=settings['lookahead_workers'],
+                                           ttl=settings['lookahead_ttl'])
+        self.concurrency = AdaptiveConcurrency(minimum=settings['adaptive_min_downloads'],
+                                               maximum=settings['adaptive_max_downloads'],
+                                               initial=settings['max_concurrent_downloads'],
+                                               enabled=settings['adaptive_concurrency'])
+        self.transcoder = Transcoder(workers=settings['transcode_workers'] or None)
+        self.stream_proxy = None
+        if settings['stream_cache_enabled']:
+            self.stream_proxy = CachingProxy(SegmentCache(settings['stream_cache_dir'],
+                                                          settings['stream_cache_max_bytes']))
         
+        self.memory = MemoryMonitor(frames=settings['tracemalloc_frames'] if settings['memory_debug'] else 0)
+        self.memory.register_cache('video info', self.video_info_cache)
+        self.memory.register_counter('Widgets', lambda: count_widgets(self.root))
+        self.memory.register_counter('Queue rows', lambda: len(self.download_frames))
+        self.memory.register_counter('Download threads', lambda: len(self.download_threads))
+        self.memory.register_counter('History rows', lambda: len(self.history_tree.get_children()))
+        self.history_shown = None
+        
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
         self.setup_ui()
+        if settings['memory_debug']:
+            self.setup_debug_menu()
         self.load_animation()
         self.update_download_list()
+        self.root.after(30000, self.schedule_tick)
+        self.root.after(settings['adaptive_interval'] * 1000, self.concurrency_tick)
+        if download_manager.shared_store:
+            self.refresh_shared_queue()
+        if settings['memory_report_interval']:
+            self.root.after(settings['memory_report_interval'] * 1000, self.memory_tick)
         
     def setup_ui(self):
         self.tab_view = ctk.CTkTabview(self.root)
@@ -157,6 +304,19 @@ class YouTubeDownloader:
         self.setup_queue_tab()
         self.setup_history_tab()
         
+    def setup_debug_menu(self):
+        menubar = tk.Menu(self.root)
+        debug_menu = tk.Menu(menubar, tearoff=0)
+        debug_menu.add_command(label="Memory Report", command=self.show_memory_report)
+        debug_menu.add_command(label="Compare With Last Snapshot",
+                               command=lambda: self.show_memory_diff('previous'))
+        debug_menu.add_command(label="Compare With First Snapshot",
+                               command=lambda: self.show_memory_diff('baseline'))
+        debug_menu.add_separator()
+        debug_menu.add_command(label="Trim Caches", command=self.trim_memory)
+        menubar.add_cascade(label="Debug", menu=debug_menu)
+        self.root.configure(menu=menubar)
+    
     def setup_download_tab(self):
         self.main_frame = ctk.CTkFrame(self.download_tab)
         self.main_frame.pack(fill="both", expand=True, padx=20, pady=20)
@@ -191,6 +351,8 @@ class YouTubeDownloader:
                           value="video").pack(side="left", padx=10)
         ctk.CTkRadioButton(format_frame, text="Audio (MP3)", variable=self.format_var, 
                           value="audio").pack(side="left", padx=10)
+        ctk.CTkRadioButton(format_frame, text="Audio (Original)", variable=self.format_var, 
+                          value="audio_original").pack(side="left", padx=10)
         
         quality_frame = ctk.CTkFrame(options_frame)
         quality_frame.pack(fill="x", pady=5)
@@ -220,6 +382,32 @@ class YouTubeDownloader:
         
         self.size_display_frame.pack_forget()  # Hide initially
         
+        schedule_frame = ctk.CTkFrame(options_frame)
+        schedule_frame.pack(fill="x", pady=5)
+        
+        ctk.CTkLabel(schedule_frame, text="Priority:").pack(side="left")
+        self.priority_var = ctk.StringVar(value="normal")
+        ctk.CTkComboBox(schedule_frame, variable=self.priority_var, values=list(PRIORITIES.keys()),
+                        width=110).pack(side="left", padx=10)
+        ctk.CTkLabel(schedule_frame, text="Deadline (HH:MM):").pack(side="left", padx=(10, 0))
+        self.deadline_entry = ctk.CTkEntry(schedule_frame, placeholder_text="optional", width=90)
+        self.deadline_entry.pack(side="left", padx=10)
+        
+        clip_frame = ctk.CTkFrame(options_frame)
+        clip_frame.pack(fill="x", pady=5)
+        
+        self.clip_var = ctk.BooleanVar(value=False)
+        ctk.CTkSwitch(clip_frame, text="Clip only", variable=self.clip_var).pack(side="left")
+        ctk.CTkLabel(clip_frame, text="Start:").pack(side="left", padx=(10, 0))
+        self.clip_start_entry = ctk.CTkEntry(clip_frame, placeholder_text="0:00", width=80)
+        self.clip_start_entry.pack(side="left", padx=5)
+        ctk.CTkLabel(clip_frame, text="End:").pack(side="left", padx=(10, 0))
+        self.clip_end_entry = ctk.CTkEntry(clip_frame, placeholder_text="0:30", width=80)
+        self.clip_end_entry.pack(side="left", padx=5)
+        self.clip_accurate_var = ctk.BooleanVar(value=False)
+        ctk.CTkCheckBox(clip_frame, text="Exact cuts (re-encode)",
+                        variable=self.clip_accurate_var).pack(side="left", padx=10)
+        
         location_frame = ctk.CTkFrame(options_frame)
         location_frame.pack(fill="x", pady=5)
         
@@ -292,6 +480,16 @@ class YouTubeDownloader:
                                   font=ctk.CTkFont(size=16, weight="bold"))
         title_label.pack(pady=10)
         
+        policy_frame = ctk.CTkFrame(queue_frame)
+        policy_frame.pack(fill="x")
+        
+        ctk.CTkLabel(policy_frame, text="Scheduling:").pack(side="left", padx=5)
+        self.policy_var = ctk.StringVar(value=download_manager.scheduler.policy.name)
+        ctk.CTkComboBox(policy_frame, variable=self.policy_var, values=list(POLICIES.keys()),
+                        command=self.change_policy, width=180).pack(side="left", padx=5)
+        self.policy_label = ctk.CTkLabel(policy_frame, text="")
+        self.policy_label.pack(side="left", padx=10)
+        
         self.queue_scroll = ctk.CTkScrollableFrame(queue_frame)
         self.queue_scroll.pack(fill="both", expand=True, pady=10)
         
@@ -307,6 +505,9 @@ class YouTubeDownloader:
         ctk.CTkButton(control_frame, text="Clear Completed", command=self.clear_completed, 
                       fg_color="#FF9866", hover_color="#FFAB80", text_color="#000000", 
                       font=ctk.CTkFont(weight="bold")).pack(side="left", padx=5)
+        ctk.CTkButton(control_frame, text="Import URLs", command=self.import_url_list, 
+                      fg_color="#FF9866", hover_color="#FFAB80", text_color="#000000", 
+                      font=ctk.CTkFont(weight="bold")).pack(side="right", padx=5)
         
     def setup_history_tab(self):
         history_frame = ctk.CTkFrame(self.history_tab)
@@ -342,6 +543,9 @@ class YouTubeDownloader:
         ctk.CTkButton(control_frame, text="Clear History", command=self.clear_history, 
                       fg_color="#FF9866", hover_color="#FFAB80", text_color="#000000", 
                       font=ctk.CTkFont(weight="bold")).pack(side="left", padx=5)
+        ctk.CTkButton(control_frame, text="Verify Folder", command=self.verify_download_folder, 
+                      fg_color="#FF9866", hover_color="#FFAB80", text_color="#000000", 
+                      font=ctk.CTkFont(weight="bold")).pack(side="left", padx=5)
         ctk.CTkButton(control_frame, text="Open Download Folder", command=self.open_download_folder, 
                       fg_color="#FF9866", hover_color="#FFAB80", text_color="#000000", 
                       font=ctk.CTkFont(weight="bold")).pack(side="right", padx=5)
@@ -349,6 +553,7 @@ class YouTubeDownloader:
     def update_download_list(self):
         # Clear existing frames for downloads not in queue or active
         current_ids = set(download_manager.active_downloads.keys()) | {item['id'] for item in download_manager.download_queue}
+        current_ids |= {item['id'] for item in download_manager.shared_items}
         
         for did in list(self.download_frames.keys()):
             if did not in current_ids:
@@ -361,6 +566,7 @@ class YouTubeDownloader:
         
         # Update queue display
         items = list(download_manager.active_downloads.values()) + list(download_manager.download_queue)
+        items += download_manager.shared_items
         
         for item in items:
             did = item['id']
@@ -408,7 +614,7 @@ class YouTubeDownloader:
                 self.control_buttons[did].pack(side="left", padx=5)
                 
                 remove_btn = ctk.CTkButton(item_frame, text="Remove", width=80, 
-                                           command=lambda d=did: (download_manager.remove_download(d), self.update_download_list()),
+                                           command=lambda d=did: self.remove_download(d),
                                            fg_color="#FF9866", hover_color="#FFAB80", text_color="#000000", 
                                            font=ctk.CTkFont(weight="bold"))
                 remove_btn.pack(side="left", padx=5)
@@ -419,19 +625,43 @@ class YouTubeDownloader:
             self.progress_bars[did].set(progress / 100)
             self.progress_labels[did].configure(text=progress_text)
             
-            if status == 'downloading':
-                self.control_buttons[did].configure(text="Pause", command=lambda d=did: (download_manager.pause_download(d), self.update_download_list()))
+            if item.get('shared'):
+                if status == 'error':
+                    self.control_buttons[did].configure(text="Retry", command=lambda d=did: (
+                        download_manager.shared_store.retry(d), self.refresh_shared_queue()))
+                else:
+                    self.control_buttons[did].configure(text=item.get('worker') or "Waiting", command=lambda: None)
+            elif status == 'downloading':
+                self.control_buttons[did].configure(text="Pause", command=lambda d=did: self.pause_download(d))
             elif status == 'queued':
                 self.control_buttons[did].configure(text="Start", command=lambda d=did: self.start_download(d))
             elif status == 'paused':
-                self.control_buttons[did].configure(text="Resume", command=lambda d=did: (download_manager.resume_download(d), self.update_download_list()))
+                self.control_buttons[did].configure(text="Resume", command=lambda d=did: self.resume_download(d))
             elif status == 'error':
                 self.control_buttons[did].configure(text="Restart", command=lambda d=did: self.restart_download(d))
+            elif status == 'converting':
+                self.control_buttons[did].configure(text="Converting", command=lambda: None)
+        
+        held = download_manager.scheduler.held_count(list(download_manager.download_queue)
+                                                     + download_manager.shared_items)
+        policy_text = download_manager.scheduler.describe()
+        if held:
+            policy_text += f" ({held} held)"
+        if self.space_held:
+            policy_text += f" ({self.space_held} waiting for disk space)"
+        if self.io_held:
+            policy_text += f" ({self.io_held} waiting for a busy disk)"
+        self.policy_label.configure(text=f"{policy_text} | {self.concurrency.describe()} | {self.io.describe()}")
         
-        # Update history display
+        # Progress hooks refresh the list many times a second, the history only changes on completion
+        history = download_manager.download_history + download_manager.shared_history
+        history_key = (len(history), history[-1].get('completed_at') if history else None)
+        if history_key == self.history_shown:
+            return
+        self.history_shown = history_key
         for item in self.history_tree.get_children():
             self.history_tree.delete(item)
-        for item in download_manager.download_history:
+        for item in history:
             disp_title = item.get('title', item['url'][:50] + "..." if len(item['url']) > 50 else item['url'])
             self.history_tree.insert("", "end", text=disp_title,
                                      values=(item['options']['format'], 
@@ -444,19 +674,7 @@ class YouTubeDownloader:
             self.location_var.set(directory)
     
     def clean_youtube_url(self, url):
-        try:
-            parsed_url = urlparse(url)
-            query_params = parse_qs(parsed_url.query)
-            video_id = query_params.get('v', [None])[0]
-            if video_id:
-                return f"https://www.youtube.com/watch?v={video_id}"
-            if parsed_url.netloc == 'youtu.be':
-                video_id = parsed_url.path[1:]
-                return f"https://www.youtube.com/watch?v={video_id}"
-            return url
-        except Exception as e:
-            print(f"Error cleaning URL: {e}")
-            return url
+        return youtube_urls.canonicalize(url)
     
     def get_video_info(self, url):
         max_retries = 3
@@ -471,7 +689,7 @@ class YouTubeDownloader:
                     'quiet': True,
                     'socket_timeout': 15,
                 }
-                with YoutubeDL(ydl_opts) as ydl:
+                with ydl_pool.session(ydl_opts) as ydl:
                     info = ydl.extract_info(clean_url, download=False)
                 class VideoInfo:
                     def __init__(self, info):
@@ -488,17 +706,7 @@ class YouTubeDownloader:
                 return None, None
     
     def extract_video_id(self, url):
-        patterns = [
-            r'(?:v=|\/)([0-9A-Za-z_-]{11}).*',
-            r'(?:embed\/)([0-9A-Za-z_-]{11})',
-            r'(?:shorts\/)([0-9A-Za-z_-]{11})',
-            r'youtu\.be\/([0-9A-Za-z_-]{11})'
-        ]
-        for pattern in patterns:
-            match = re.search(pattern, url)
-            if match:
-                return match.group(1)
-        return None
+        return youtube_urls.extract_video_id(url)
     
     def preview_video(self):
         url = self.url_entry.get().strip()
@@ -518,7 +726,7 @@ class YouTubeDownloader:
         self.main_frame.pack(fill="both", expand=True, padx=20, pady=20)
         self.update_file_size()
         if self.player:
-            self.player.stop()
+            self.release_player()
             self.is_playing = False
             self.play_pause_btn.configure(text="▶")
             self.fullscreen_btn.configure(state="normal")
@@ -549,9 +757,13 @@ class YouTubeDownloader:
                     continue
             if not img_data:
                 raise Exception("Could not retrieve thumbnail")
-            img = Image.open(BytesIO(img_data))
-            img = img.resize((160, 90), Image.Resampling.LANCZOS)
-            self.thumbnail_photo = ctk.CTkImage(light_image=img, dark_image=img, size=(160, 90))
+            with Image.open(BytesIO(img_data)) as source:
+                img = source.resize((160, 90), Image.Resampling.LANCZOS)
+            # One CTkImage for the session, a new one per preview keeps its scaled PhotoImages alive
+            if self.thumbnail_photo is None:
+                self.thumbnail_photo = ctk.CTkImage(light_image=img, dark_image=img, size=(160, 90))
+            else:
+                self.thumbnail_photo.configure(light_image=img, dark_image=img)
             preview_container = ctk.CTkFrame(self.preview_frame)
             preview_container.pack(fill="x", pady=5)
             thumbnail_label = ctk.CTkLabel(preview_container, image=self.thumbnail_photo, text="")
@@ -617,6 +829,15 @@ class YouTubeDownloader:
             self.volume_slider.set(50)
             self.volume_slider.pack(side="left", padx=10)
             
+            clip_controls = ctk.CTkFrame(video_container)
+            clip_controls.pack(fill="x", pady=5)
+            ctk.CTkButton(clip_controls, text="Mark In", width=80, command=lambda: self.set_clip_mark("start"),
+                          fg_color="#FF9866", hover_color="#FFAB80", text_color="#000000",
+                          font=ctk.CTkFont(weight="bold")).pack(side="left", padx=10)
+            ctk.CTkButton(clip_controls, text="Mark Out", width=80, command=lambda: self.set_clip_mark("end"),
+                          fg_color="#FF9866", hover_color="#FFAB80", text_color="#000000",
+                          font=ctk.CTkFont(weight="bold")).pack(side="left", padx=10)
+            
         except Exception as e:
             error_label = ctk.CTkLabel(self.preview_frame, text=f"Preview unavailable: {str(e)}", text_color="red")
             error_label.pack(pady=10)
@@ -672,13 +893,16 @@ class YouTubeDownloader:
     def play_stream(self, url, stream_type="video"):
         try:
             self.start_loading_animation()
-            if self.player:
-                self.player.stop()
+            self.release_player()
+            for widget in self.video_frame.winfo_children():
+                widget.destroy()
             self.is_audio_only = (stream_type == "audio")
             stream_url = self.get_stream_url(url, stream_type)
             media = self.vlc_instance.media_new(stream_url)
             self.player = self.vlc_instance.media_player_new()
             self.player.set_media(media)
+            # The player holds its own reference to the media
+            media.release()
             if not self.is_audio_only:
                 self.player.set_hwnd(self.video_frame.winfo_id())
             else:
@@ -704,6 +928,12 @@ class YouTubeDownloader:
             self.stop_loading_animation()
             messagebox.showerror("Error", f"Failed to play {'audio' if self.is_audio_only else 'video'}: {str(e)}")
     
+    def release_player(self):
+        if self.player:
+            self.player.stop()
+            self.player.release()
+            self.player = None
+    
     def on_playback_error(self):
         self.stop_loading_animation()
         messagebox.showerror("Error", f"Failed to play {'audio' if self.is_audio_only else 'video'}: Playback error")
@@ -752,17 +982,42 @@ class YouTubeDownloader:
                 self.player.audio_set_mute(False)
                 self.mute_btn.configure(text="🔊")
     
+    def set_clip_mark(self, which):
+        if not self.player:
+            return
+        position_ms = self.player.get_time()
+        if position_ms < 0:
+            return
+        entry = self.clip_start_entry if which == "start" else self.clip_end_entry
+        entry.delete(0, "end")
+        entry.insert(0, self.format_timestamp(position_ms / 1000))
+        self.clip_var.set(True)
+    
+    def format_timestamp(self, seconds):
+        return downloader.format_timestamp(seconds)
+    
+    def parse_timestamp(self, text):
+        seconds = 0.0
+        for part in text.strip().split(':'):
+            seconds = seconds * 60 + float(part)
+        return seconds
+    
     def get_stream_url(self, url, stream_type="video"):
         max_retries = 3
         for attempt in range(max_retries):
             try:
+                options = {'format': self.format_var.get(), 'quality': self.quality_var.get()}
                 ydl_opts = {
-                    'format': 'bestaudio[abr<=128]/bestaudio' if stream_type == "audio" else 'best',
+                    'format': downloader.preview_format(stream_type, options, self.check_ffmpeg()),
                     'quiet': True,
                     'socket_timeout': 15,
                 }
-                with YoutubeDL(ydl_opts) as ydl:
+                with ydl_pool.session(ydl_opts) as ydl:
                     info = ydl.extract_info(url, download=False)
+                if self.stream_proxy and info.get('id') and info.get('format_id'):
+                    return self.stream_proxy.register(info['id'], info['format_id'], info['url'],
+                                                      headers=info.get('http_headers'),
+                                                      total_size=info.get('filesize'))
                 return info['url']
             except Exception as e:
                 if attempt < max_retries - 1:
@@ -780,40 +1035,321 @@ class YouTubeDownloader:
         yt, video_id = self.get_video_info(clean_url)
         if not yt:
             return
+        options = self.current_options()
+        if options is None:
+            return
+        download_id = download_manager.add_download(clean_url, options, title=yt.title)
+        self.update_download_list()
+        self.status_label.configure(text="Download added to queue!")
+        # Starts right away when there is room and the scheduler doesn't hold it
+        self.start_if_ready(download_id)
+        threading.Thread(target=self.estimate_item_size, args=(download_id, clean_url, options), daemon=True).start()
+    
+    def current_options(self):
         options = {
             'format': self.format_var.get(),
             'quality': self.quality_var.get(),
-            'location': self.location_var.get()
+            'location': self.location_var.get(),
+            'priority': PRIORITIES.get(self.priority_var.get(), 0)
         }
-        download_id = download_manager.add_download(clean_url, options, title=yt.title)
-        self.update_download_list()
-        self.status_label.configure(text="Download added to queue!")
-        if len(download_manager.active_downloads) < 3:
-            self.start_download(download_id)
+        deadline = self.deadline_entry.get().strip()
+        if deadline:
+            try:
+                options['deadline'] = self.parse_deadline(deadline)
+            except ValueError:
+                messagebox.showerror("Error", "Deadline must be in HH:MM format")
+                return None
+        if self.clip_var.get():
+            try:
+                start = self.parse_timestamp(self.clip_start_entry.get() or "0")
+                end = self.parse_timestamp(self.clip_end_entry.get())
+            except ValueError:
+                messagebox.showerror("Error", "Clip start and end must be timestamps like 1:23 or 0:01:23")
+                return None
+            if end <= start:
+                messagebox.showerror("Error", "Clip end must be after clip start")
+                return None
+            options['clip'] = {'start': start, 'end': end, 'accurate': self.clip_accurate_var.get()}
+        return options
+    
+    def parse_deadline(self, text):
+        hours, minutes = (int(part) for part in text.split(':'))
+        if not (0 <= hours < 24 and 0 <= minutes < 60):
+            raise ValueError(text)
+        now = time.localtime()
+        deadline = time.mktime((now.tm_year, now.tm_mon, now.tm_mday, hours, minutes, 0, 0, 0, -1))
+        if deadline <= time.time():
+            deadline += 24 * 3600
+        return deadline
+    
+    def estimate_item_size(self, download_id, url, options):
+        # Size estimates feed the scheduler, the item may already be running when this finishes
+        filesize_mb = self.get_file_size(url, options['format'], options['quality'])
+        clip = options.get('clip')
+        if filesize_mb and clip:
+            duration = (self.video_info_cache.get(self.clean_youtube_url(url)) or {}).get('duration')
+            if duration:
+                filesize_mb *= min(1, (clip['end'] - clip['start']) / duration)
+        if filesize_mb:
+            download_manager.set_estimated_bytes(download_id, int(filesize_mb * 1024 * 1024))
+        # With an estimate an item held as possibly large may turn out small enough to start
+        self.root.after(0, self.fill_slots if self.queue_running else lambda: (
+            self.start_if_ready(download_id), self.update_download_list()))
+    
+    def import_url_list(self):
+        path = filedialog.askopenfilename(filetypes=[("Text files", "*.txt"), ("All files", "*.*")])
+        if not path:
+            return
+        with open(path, 'r', encoding='utf-8') as f:
+            # One URL per line, blank lines and # comments are skipped
+            lines = [line.strip() for line in f.read().splitlines()]
+        urls, playlists, invalid = youtube_urls.normalize_many(
+            [line for line in lines if line and not line.startswith('#')])
+        if playlists:
+            # Each queue entry downloads one video, a playlist URL would be queued as a single item
+            print(f"Skipping {len(playlists)} playlist URLs, add their videos one by one")
+        if invalid:
+            print(f"Skipping {len(invalid)} lines that are not YouTube URLs")
+        if not urls:
+            messagebox.showerror("Error", "No YouTube video URLs found in the selected file")
+            return
+        options = self.current_options()
+        if options is None:
+            return
+        # A clip range only makes sense for the video it was marked on
+        options.pop('clip', None)
+        self.status_label.configure(text=f"Resolving {len(urls)} URLs...")
+        threading.Thread(target=self.resolve_imported_urls, args=(urls, options), daemon=True).start()
+    
+    def resolve_imported_urls(self, urls, options):
+        # Metadata extraction is CPU bound, so big imports go through the process pool
+        entries = []
+        failed = 0
+        ffmpeg_available = self.check_ffmpeg()
+        for url, record, error in self.metadata_resolver.resolve_many(urls):
+            if record:
+                filesize_mb = self.estimate_file_size(record, options['format'], options['quality'], ffmpeg_available)
+                estimated_bytes = int(filesize_mb * 1024 * 1024) if filesize_mb else None
+                entries.append((url, options, record['title'], estimated_bytes))
+            else:
+                failed += 1
+                print(f"Failed to resolve {url}: {error}")
+        download_manager.add_downloads(entries)
+        message = f"Imported {len(entries)} downloads" + (f", {failed} failed" if failed else "")
+        self.root.after(0, lambda: (self.update_download_list(), self.status_label.configure(text=message)))
+    
+    def reserve_space(self, item):
+        try:
+            return self.disk_reservations.try_reserve(item['id'], item['options']['location'],
+                                                      item.get('estimated_bytes'),
+                                                      space_factor(item['options'], self.check_ffmpeg()))
+        except OSError as e:
+            # Can't measure the destination, let the download report its own error
+            print(f"Disk space check failed for {item['options']['location']}: {e}")
+            return True
     
     def start_download(self, download_id):
+        queued = next((item for item in download_manager.download_queue if item['id'] == download_id), None)
+        if queued and not self.reserve_space(queued):
+            self.status_label.configure(text=f"Waiting for disk space: {queued['options']['location']}")
+            return False
         item = download_manager.start_download(download_id)
         if item:
+            self.io.start_writing(download_id, item['options']['location'])
             self.status_label.configure(text=f"Starting download: {item['url'][:30]}...")
             self.update_download_list()
-            threading.Thread(target=self.process_download, args=(download_id,), daemon=True).start()
+            self.spawn_download(download_id)
+            return True
+        self.disk_reservations.release(download_id)
+        return False
+    
+    def start_if_ready(self, download_id):
+        # fill_slots for a single item: scheduler holds, then host and disk limits
+        item = next((item for item in download_manager.next_downloads() if item['id'] == download_id), None)
+        if item is None:
+            return False
+        host = host_of(item['url'])
+        if self.active_by_host().get(host, 0) >= self.concurrency.limit(host):
+            return False
+        if not self.io.can_start(item['options']['location']):
+            return False
+        return self.start_download(download_id)
+    
+    def active_by_host(self):
+        counts = {}
+        for item in list(download_manager.active_downloads.values()):
+            # Items in post-processing no longer use the link
+            if item['status'] != 'downloading':
+                continue
+            host = host_of(item['url'])
+            counts[host] = counts.get(host, 0) + 1
+        return counts
+    
+    def fill_slots(self):
+        active = self.active_by_host()
+        self.space_held = 0
+        self.io_held = 0
+        for item in download_manager.next_downloads():
+            host = host_of(item['url'])
+            if active.get(host, 0) >= self.concurrency.limit(host):
+                continue
+            # Skipping a busy disk lets items for other disks further down the queue start
+            if not self.io.can_start(item['options']['location']):
+                self.io_held += 1
+                continue
+            if not self.start_download(item['id']):
+                self.space_held += 1
+                continue
+            active[host] = active.get(host, 0) + 1
+        self.prefetch_upcoming()
+        self.update_download_list()
+    
+    def prefetch_upcoming(self):
+        upcoming = download_manager.next_downloads(settings['lookahead_depth'])
+        self.lookahead.prefetch([self.clean_youtube_url(item['url']) for item in upcoming])
+    
+    def refresh_shared_queue(self):
+        try:
+            download_manager.refresh_shared()
+        except Exception as e:
+            print(f"Failed to read shared queue: {e}")
+        self.update_download_list()
+        if not self.shared_refresh_pending:
+            self.shared_refresh_pending = True
+            self.root.after(settings['shared_queue_poll'] * 1000, self.shared_queue_tick)
+    
+    def shared_queue_tick(self):
+        self.shared_refresh_pending = False
+        self.refresh_shared_queue()
+    
+    def concurrency_tick(self):
+        if self.concurrency.evaluate(self.active_by_host()) and self.queue_running:
+            self.fill_slots()
+        self.root.after(settings['adaptive_interval'] * 1000, self.concurrency_tick)
+    
+    def schedule_tick(self):
+        # Picks up items released by the off-peak window or waiting for a free slot
+        if self.queue_running:
+            self.fill_slots()
+        else:
+            self.update_download_list()
+            self.prefetch_upcoming()
+        self.root.after(30000, self.schedule_tick)
+    
+    def change_policy(self, policy_name):
+        download_manager.scheduler.set_policy(policy_name)
+        download_manager.publish_policy()
+        download_manager.save_state()
+        self.update_download_list()
+        self.status_label.configure(text=f"Scheduling policy: {policy_name}")
     
     def start_all_downloads(self):
-        count = 0
+        self.queue_running = True
+        self.fill_slots()
+    
+    def spawn_download(self, download_id):
+        token = self.cancellation.create(download_id)
+        thread = threading.Thread(target=self.process_download, args=(download_id, token), daemon=True)
+        self.download_threads[download_id] = thread
+        thread.start()
+    
+    def pause_download(self, download_id):
+        # Partial files stay in the staging folder, yt-dlp continues them on resume
+        item = download_manager.active_downloads.get(download_id, {})
+        if item.get('status') == 'converting':
+            return
+        if download_manager.pause_download(download_id):
+            self.cancellation.cancel(download_id, 'pause')
+            self.report_clip_stop(download_id, item)
+        self.update_download_list()
+    
+    def resume_download(self, download_id):
         for item in list(download_manager.download_queue):
-            if count >= 3 - len(download_manager.active_downloads):
-                break
-            if item['status'] == 'queued':
-                self.start_download(item['id'])
-                count += 1
+            if item['id'] == download_id and item['status'] == 'paused':
+                item['status'] = 'queued'
+                self.start_download(download_id)
+        self.update_download_list()
+    
+    def track_partial(self, item, data):
+        # Remembered on the item, so a paused download removed later can still be cleaned up
+        partial_files = item.setdefault('partial_files', [])
+        for path in (data.get('tmpfilename'), data.get('filename')):
+            if path and path not in partial_files:
+                partial_files.append(path)
+    
+    def remove_download(self, download_id):
+        item = download_manager.active_downloads.get(download_id) or next(
+            (queued for queued in download_manager.download_queue if queued['id'] == download_id), None)
+        download_manager.remove_download(download_id)
+        # A running thread also cleans up once it has stopped writing
+        self.cancellation.cancel(download_id, 'remove')
+        if item:
+            write_path.remove_partials(item.get('partial_files', []))
+            self.report_clip_stop(download_id, item)
         self.update_download_list()
     
+    def report_clip_stop(self, download_id, item):
+        # Clips are cut by ffmpeg, which can't be interrupted (see build_ydl_opts)
+        if item.get('options', {}).get('clip') and download_id in self.download_threads:
+            self.status_label.configure(text="The clip stops once ffmpeg has finished its section")
+    
     def pause_all_downloads(self):
-        for download_id in list(download_manager.active_downloads.keys()):
-            download_manager.pause_download(download_id)
+        self.queue_running = False
+        active = [download_id for download_id, item in list(download_manager.active_downloads.items())
+                  if item['status'] != 'converting']
+        for download_id in download_manager.pause_downloads(active):
+            self.cancellation.cancel(download_id, 'pause')
         self.update_download_list()
         self.status_label.configure(text="All downloads paused")
     
+    def on_close(self):
+        if self.closing:
+            return
+        self.closing = True
+        self.queue_running = False
+        self.status_label.configure(text="Stopping downloads...")
+        # Active items go back to the queue as paused so the next start resumes them
+        download_manager.pause_downloads(list(download_manager.active_downloads.keys()))
+        self.cancellation.cancel_all('shutdown')
+        self.release_player()
+        self.wait_for_downloads(time.time() + settings['shutdown_timeout'])
+    
+    def wait_for_downloads(self, deadline):
+        # Keeps the event loop running so worker threads can finish their UI callbacks
+        alive = [thread for thread in self.download_threads.values() if thread.is_alive()]
+        if alive and time.time() < deadline:
+            self.root.after(50, lambda: self.wait_for_downloads(deadline))
+            return
+        if alive:
+            print(f"{len(alive)} downloads did not stop in time")
+        self.transcoder.shutdown()
+        self.lookahead.shutdown()
+        self.metadata_resolver.shutdown()
+        if self.stream_proxy:
+            self.stream_proxy.stop()
+        ydl_pool.clear()
+        download_manager.save_state()
+        self.root.destroy()
+    
+    def memory_tick(self):
+        self.show_memory_report()
+        self.root.after(settings['memory_report_interval'] * 1000, self.memory_tick)
+    
+    def show_memory_report(self):
+        lines = self.memory.report()
+        print("\n".join(lines))
+        self.status_label.configure(text=lines[0])
+    
+    def show_memory_diff(self, against):
+        lines = self.memory.diff(against)
+        print("\n".join(lines))
+        self.status_label.configure(text=f"Memory snapshot compared with {against} one, see console")
+    
+    def trim_memory(self):
+        evicted = self.memory.trim_caches()
+        ydl_pool.clear()
+        self.status_label.configure(text=f"Trimmed caches, {evicted} entries evicted")
+    
     def clear_completed(self):
         download_manager.download_history = [
             item for item in download_manager.download_history 
@@ -836,9 +1372,36 @@ class YouTubeDownloader:
         else:
             messagebox.showerror("Error", f"Download folder not found: {path}")
     
+    def verify_download_folder(self):
+        path = self.location_var.get()
+        if not os.path.exists(path):
+            messagebox.showerror("Error", f"Download folder not found: {path}")
+            return
+        self.status_label.configure(text=f"Verifying {path}...")
+        threading.Thread(target=self.run_folder_verification, args=(path,), daemon=True).start()
+    
+    def run_folder_verification(self, path):
+        result = integrity.verify_folder(path)
+        duplicates = integrity.find_duplicates([path])
+        summary = (f"{len(result['ok']) + len(result['rehashed'])} files OK, "
+                   f"{len(result['corrupt'])} corrupt, {len(result['missing'])} missing, "
+                   f"{len(duplicates)} duplicate groups")
+        details = "\n".join(([f"Corrupt: {name}" for name in result['corrupt']] +
+                             [f"Missing: {name}" for name in result['missing']])[:20])
+        def show():
+            self.status_label.configure(text=f"Verification finished: {summary}")
+            if result['corrupt'] or result['missing']:
+                messagebox.showwarning("Verification", f"{summary}\n\n{details}")
+            else:
+                messagebox.showinfo("Verification", summary)
+        self.root.after(0, show)
+    
     def restart_download(self, download_id):
         if download_id in download_manager.active_downloads:
             item = download_manager.active_downloads[download_id]
+            if not self.reserve_space(item):
+                self.status_label.configure(text=f"Waiting for disk space: {item['options']['location']}")
+                return
             item['status'] = 'downloading'
             item['progress'] = 0
             item.pop('downloaded_bytes', None)
@@ -846,7 +1409,8 @@ class YouTubeDownloader:
             item.pop('speed', None)
             item.pop('eta', None)
             download_manager.save_state()
-            threading.Thread(target=self.process_download, args=(download_id,), daemon=True).start()
+            self.io.start_writing(download_id, item['options']['location'])
+            self.spawn_download(download_id)
             self.update_download_list()
     
     def get_file_size(self, url, format_type, quality):
@@ -869,8 +1433,8 @@ class YouTubeDownloader:
                 max_retries = 3
                 for attempt in range(max_retries):
                     try:
-                        with YoutubeDL(ydl_opts) as ydl:
-                            info = ydl.extract_info(clean_url, download=False)
+                        with ydl_pool.session(ydl_opts) as ydl:
+                            info = load_record(compact_record(ydl.extract_info(clean_url, download=False)))
                         self.video_info_cache[clean_url] = info
                         self.current_url = clean_url
                         break
@@ -881,7 +1445,15 @@ class YouTubeDownloader:
                             continue
                         return None
             
-            duration = info.get('duration', 0)
+            return self.estimate_file_size(info, format_type, quality, ffmpeg_available)
+        except Exception as e:
+            print(f"Error getting file size: {e}")
+            return None
+    
+    def estimate_file_size(self, info, format_type, quality, ffmpeg_available):
+        # Works on full info dicts as well as the compact records from the metadata pool
+        try:
+            duration = info.get('duration') or 0
             
             if format_type == "video":
                 format_selector = None
@@ -914,89 +1486,91 @@ class YouTubeDownloader:
                             if tbr and duration:
                                 return (duration * tbr * 1000 / 8) / (1024 * 1024)
                 return None
+            elif format_type == "audio_original":
+                audio_formats = [fmt for fmt in info.get('formats', [])
+                                 if fmt.get('vcodec') == 'none' and fmt.get('acodec') not in (None, 'none')]
+                bitrate = max((fmt.get('abr') or fmt.get('tbr') or 0 for fmt in audio_formats), default=0) or 128
+                if duration:
+                    return (duration * bitrate * 1000 / 8) / (1024 * 1024)
+                return None
             else:
                 bitrate = 192 if ffmpeg_available else 128
                 if duration:
                     return (duration * bitrate * 1000 / 8) / (1024 * 1024)
                 return None
         except Exception as e:
-            print(f"Error getting file size: {e}")
+            print(f"Error estimating file size: {e}")
             return None
     
     def check_ffmpeg(self):
         return shutil.which("ffmpeg") is not None
     
-    def process_download(self, download_id):
+    def process_download(self, download_id, token):
         item = download_manager.active_downloads.get(download_id)
-        if not item or item['status'] != 'downloading':
+        if not item or item['status'] != 'downloading' or token.cancelled:
+            if self.owns_download(download_id, token):
+                self.disk_reservations.release(download_id)
+                self.io.finish_writing(download_id)
+            self.cancellation.discard(download_id, token)
             return
+        merge_gate = None
         try:
             self.root.after(0, lambda: self.status_label.configure(text=f"Downloading: {item['url'][:30]}..."))
             clean_url = self.clean_youtube_url(item['url'])
             download_path = item['options']['location']
             format_type = item['options']['format']
-            quality = item['options']['quality']
             
-            ydl_opts = {
-                'outtmpl': f"{download_path}/%(title)s.%(ext)s",
-                'progress_hooks': [lambda d: self.on_progress(download_id, d)],
-                'noplaylist': True,
-                'socket_timeout': 15,
-            }
+            staged = settings['staged_writes']
+            write_dir = write_path.staging_dir(download_path) if staged else download_path
+            hasher = integrity.StreamingHasher()
+            progress_hooks = [hasher.on_progress, lambda d: self.track_partial(item, d),
+                              lambda d: self.on_progress(download_id, d, token)]
+            if settings['preallocate']:
+                preallocator = write_path.Preallocator(
+                    lambda path, size: self.disk_reservations.record_preallocated(download_id, path, size))
+                progress_hooks.insert(0, preallocator.on_progress)
             
             ffmpeg_available = self.check_ffmpeg()
+            ydl_opts = downloader.build_ydl_opts(item['options'], write_dir, progress_hooks,
+                                                 settings, ffmpeg_available)
+            merge_gate = self.io.merge_gate(download_path, token)
+            ydl_opts['postprocessor_hooks'] = [merge_gate.on_postprocessor]
+            if not ffmpeg_available and format_type == "video":
+                self.root.after(0, lambda: self.status_label.configure(
+                    text="Warning: ffmpeg not found. Using single stream format, quality may be limited.",
+                    text_color="yellow"))
+            elif not ffmpeg_available and format_type == "audio":
+                self.root.after(0, lambda: self.status_label.configure(
+                    text="Warning: ffmpeg not found. Downloading as M4A instead of MP3.",
+                    text_color="yellow"))
             
-            if format_type == "video":
-                if ffmpeg_available:
-                    if quality == "highest":
-                        ydl_opts['format'] = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]'
-                    elif quality == "lowest":
-                        ydl_opts['format'] = 'worstvideo[ext=mp4]+worstaudio[ext=m4a]/worst[ext=mp4]'
-                    else:
-                        height = quality[:-1]
-                        ydl_opts['format'] = f'bestvideo[height<={height}][ext=mp4]+bestaudio[ext=m4a]/best[height<={height}][ext=mp4]'
-                else:
-                    if quality == "highest":
-                        ydl_opts['format'] = 'best[ext=mp4]'
-                    elif quality == "lowest":
-                        ydl_opts['format'] = 'worst[ext=mp4]'
-                    else:
-                        height = quality[:-1]
-                        ydl_opts['format'] = f'best[height<={height}][ext=mp4]'
-                    self.root.after(0, lambda: self.status_label.configure(
-                        text="Warning: ffmpeg not found. Using single stream format, quality may be limited.",
-                        text_color="yellow"))
-            else:
-                ydl_opts['format'] = 'bestaudio'
-                if ffmpeg_available:
-                    ydl_opts['postprocessors'] = [{
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': 'mp3',
-                        'preferredquality': '192',
-                    }]
-                else:
-                    ydl_opts['format'] = 'bestaudio[ext=m4a]'
-                    self.root.after(0, lambda: self.status_label.configure(
-                        text="Warning: ffmpeg not found. Downloading as M4A instead of MP3.",
-                        text_color="yellow"))
+            clip = item['options'].get('clip')
+            prefetched = self.lookahead.take(clean_url)
+            if not clip:
+                prefetched = self.fill_from_stream_cache(download_id, clean_url, ydl_opts, token, prefetched)
+            output_file, info = downloader.run_ydl(
+                clean_url, ydl_opts,
+                on_error=lambda e: self.concurrency.record_error(host_of(item['url'])),
+                prefetched=prefetched, token=token)
+            if 'title' in info and not item.get('title'):
+                item['title'] = info['title']
+            # A pause during yt-dlp's merge only takes effect once it returns; the merged
+            # file stays in staging and the resumed download picks it up from there
+            token.raise_if_cancelled()
             
-            max_retries = 3
-            for attempt in range(max_retries):
-                try:
-                    with YoutubeDL(ydl_opts) as ydl:
-                        info = ydl.extract_info(clean_url, download=True)
-                        if 'title' in info and not item.get('title'):
-                            item['title'] = info['title']
-                        output_file = ydl.prepare_filename(info)
-                    break
-                except Exception as e:
-                    if attempt < max_retries - 1:
-                        print(f"Retry {attempt + 1}/{max_retries} for download: {e}")
-                        time.sleep(2)
-                        continue
-                    raise
+            if downloader.needs_transcode(item['options'], ffmpeg_available):
+                item['status'] = 'converting'
+                if self.owns_download(download_id, token):
+                    self.io.finish_writing(download_id)
+                self.root.after(0, self.fill_slots if self.queue_running else self.update_download_list)
+                with self.io.merge_slot(download_path, token):
+                    output_file = self.transcoder.submit(output_file, 'mp3', settings['mp3_bitrate'], token).result()
+                token.raise_if_cancelled()
             
-            download_manager.complete_download(download_id, output_file)
+            output_file, details = downloader.finish_download(output_file, download_path, hasher,
+                                                              format_type, staged)
+            item.pop('partial_files', None)
+            download_manager.complete_download(download_id, output_file, details)
             self.root.after(0, lambda: self.status_label.configure(text=f"Download completed: {os.path.basename(output_file)}"))
         except Exception as e:
             if "Download interrupted" in str(e):
@@ -1011,9 +1585,63 @@ class YouTubeDownloader:
                 if download_id in download_manager.active_downloads:
                     download_manager.active_downloads[download_id]['status'] = 'error'
                 self.root.after(0, lambda: self.status_label.configure(text=error_msg, text_color="red"))
-        self.root.after(0, self.update_download_list)
+        if merge_gate:
+            merge_gate.close()
+        if self.owns_download(download_id, token):
+            self.concurrency.forget(download_id)
+            self.disk_reservations.release(download_id)
+            self.io.finish_writing(download_id)
+        if self.download_threads.get(download_id) is threading.current_thread():
+            del self.download_threads[download_id]
+        if token.reason == 'remove':
+            # Files still being written when Remove was pressed are gone only now
+            write_path.remove_partials(item.get('partial_files', []))
+        self.cancellation.discard(download_id, token)
+        if self.closing:
+            return
+        self.root.after(0, self.fill_slots if self.queue_running else self.update_download_list)
+    
+    def owns_download(self, download_id, token):
+        # False once a resumed or restarted run has registered a newer token,
+        # the reservation and disk slot then belong to that run
+        return self.cancellation.tokens.get(download_id) is token
+    
+    def fill_from_stream_cache(self, download_id, url, ydl_opts, token, prefetched=None):
+        # Reuses bytes fetched while previewing when the download picks the same single format.
+        # The file is put where yt-dlp would write it, so run_ydl finds it already downloaded
+        # and still runs the fixups and postprocessors (FixupM4a, the remux) on it.
+        # Returns the unprocessed info, handed on to run_ydl so it isn't extracted twice.
+        video_id = self.extract_video_id(url)
+        if (not self.stream_proxy or not video_id or not downloader.is_single_stream(ydl_opts['format'])
+                or not self.stream_proxy.cache.has_video(video_id)):
+            return prefetched
+        try:
+            with YoutubeDL(dict(ydl_opts, quiet=True)) as ydl:
+                if prefetched is None:
+                    prefetched = ydl.extract_info(url, download=False, process=False)
+                # Format selection only, on a copy since it fills in the info dict
+                info = ydl.process_ie_result(copy.deepcopy(prefetched), download=False)
+                if info.get('requested_formats') or not info.get('url'):
+                    return prefetched
+                if not self.stream_proxy.cache.has(cache_key(info['id'], info['format_id'])):
+                    return prefetched
+                output_file = ydl.prepare_filename(info)
+            progress = lambda done, total: self.on_progress(download_id, {
+                'status': 'downloading', 'downloaded_bytes': done, 'total_bytes': total,
+                'tmpfilename': output_file}, token)
+            self.stream_proxy.fill(info['id'], info['format_id'], info['url'], output_file,
+                                   headers=info.get('http_headers'),
+                                   total_size=info.get('filesize'), progress=progress)
+        except Exception as e:
+            if "Download interrupted" in str(e):
+                raise
+            print(f"Stream cache unavailable, downloading normally: {e}")
+        return prefetched
     
-    def on_progress(self, download_id, data):
+    def on_progress(self, download_id, data, token):
+        # The thread's own token: after a quick pause and resume the registry
+        # already holds the new run's token while the old thread winds down
+        token.raise_if_cancelled()
         item = download_manager.active_downloads.get(download_id)
         if item and data['status'] == 'downloading':
             if 'total_bytes' in data and data['total_bytes'] > 0 and 'downloaded_bytes' in data:
@@ -1026,14 +1654,34 @@ class YouTubeDownloader:
             item['total_bytes'] = data.get('total_bytes', data.get('total_bytes_estimate', 0))
             item['speed'] = data.get('speed')
             item['eta'] = data.get('eta')
+            self.concurrency.record_progress(download_id, host_of(item['url']), data)
+            self.disk_reservations.record_written(download_id, data)
+            self.io.record_progress(download_id, data)
             if item['status'] != 'downloading':
                 raise Exception("Download interrupted")
             self.root.after(0, self.update_download_list)
 
 def main():
+    global settings, ydl_pool, download_manager
+    parser = argparse.ArgumentParser(description="Advanced YouTube Downloader")
+    parser.add_argument('--memory-debug', action='store_true',
+                        help="trace allocations from startup and show the Debug menu")
+    parser.add_argument('--memory-report', type=int, metavar='SECONDS',
+                        help="print a memory report every SECONDS")
+    args = parser.parse_args()
+    settings = load_settings()
+    ydl_pool = YoutubeDLPool(max_idle_per_key=settings['ydl_pool_max_idle'],
+                             max_uses=settings['ydl_pool_max_uses'],
+                             max_age=settings['ydl_pool_max_age'])
+    download_manager = DownloadManager()
+    if args.memory_debug:
+        settings['memory_debug'] = True
+    if args.memory_report is not None:
+        settings['memory_report_interval'] = args.memory_report
     root = ctk.CTk()
     app = YouTubeDownloader(root)
     root.mainloop()
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     main()
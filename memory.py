@@ -0,0 +1,229 @@
+import gc
+import os
+import sys
+import threading
+import tracemalloc
+from collections import Counter, OrderedDict
+
+
+def approx_size(obj, limit=200000):
+    # Walks containers without recursion, close enough for cache budgets
+    seen = set()
+    stack = [obj]
+    total = 0
+    while stack and len(seen) < limit:
+        current = stack.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        total += sys.getsizeof(current)
+        if isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            stack.extend(current)
+    return total
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        # Peak rather than current, but still shows whether it keeps climbing
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        return None
+
+
+def count_widgets(root):
+    count = 0
+    stack = [root]
+    while stack:
+        widget = stack.pop()
+        count += 1
+        stack.extend(widget.winfo_children())
+    return count
+
+
+class BoundedCache:
+    # Dict-like LRU with an entry and a byte budget, the least recently used
+    # entries are evicted as soon as either one is exceeded.
+    def __init__(self, max_entries=128, max_bytes=None, sizeof=approx_size):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __getitem__(self, key):
+        with self.lock:
+            value, _ = self.entries[key]
+            self.entries.move_to_end(key)
+            return value
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(value) if self.max_bytes else 0
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self.entries[key] = (value, size)
+            self.total_bytes += size
+            self._evict(self.max_entries, self.max_bytes)
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return default
+            self.total_bytes -= entry[1]
+            return entry[0]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def _evict(self, max_entries, max_bytes):
+        evicted = 0
+        # The newest entry is kept even if it alone is over the byte budget
+        while len(self.entries) > 1 and ((max_entries is not None and len(self.entries) > max_entries)
+                                         or (max_bytes and self.total_bytes > max_bytes)):
+            _, (_, size) = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            evicted += 1
+        if max_entries == 0 and self.entries:
+            evicted += len(self.entries)
+            self.entries.clear()
+            self.total_bytes = 0
+        self.evictions += evicted
+        return evicted
+
+    def trim(self, fraction=0.5):
+        # Shrinks to a fraction of the budget, used when the process is asked to give memory back
+        with self.lock:
+            max_entries = int(len(self.entries) * fraction)
+            max_bytes = int(self.total_bytes * fraction) if self.max_bytes else None
+            return self._evict(max_entries, max_bytes)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class MemoryMonitor:
+    # Collects what is needed to tell a leak from normal churn in a long session:
+    # resident size, cache budgets, object counts by type and tracemalloc diffs.
+    def __init__(self, frames=0):
+        self.caches = {}
+        self.counters = {}
+        self.baseline = None
+        self.latest = None
+        self.last_counts = None
+        if frames:
+            self.start_tracing(frames)
+
+    def register_cache(self, name, cache):
+        self.caches[name] = cache
+
+    def register_counter(self, name, func):
+        # func returns a number, e.g. widget or queue row counts
+        self.counters[name] = func
+
+    @property
+    def tracing(self):
+        return tracemalloc.is_tracing()
+
+    def start_tracing(self, frames=25):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    def take_snapshot(self):
+        self.start_tracing()
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ))
+        if self.baseline is None:
+            self.baseline = snapshot
+        self.latest = snapshot
+        return snapshot
+
+    def diff(self, against='previous', top=15, key_type='lineno'):
+        # Takes a fresh snapshot and compares it with the baseline or the last one taken
+        reference = self.baseline if against == 'baseline' else self.latest
+        if reference is None:
+            self.take_snapshot()
+            return ["First snapshot taken, compare again later to see growth"]
+        snapshot = self.take_snapshot()
+        stats = snapshot.compare_to(reference, key_type)
+        lines = [f"Top {top} allocation changes since {against} snapshot:"]
+        lines += [str(stat) for stat in stats[:top]]
+        return lines
+
+    def object_counts(self, top=15):
+        counts = Counter(type(obj).__name__ for obj in gc.get_objects())
+        previous, self.last_counts = self.last_counts, counts
+        if previous is None:
+            return [(name, count, 0) for name, count in counts.most_common(top)]
+        growth = sorted(counts, key=lambda name: counts[name] - previous.get(name, 0), reverse=True)
+        return [(name, counts[name], counts[name] - previous.get(name, 0)) for name in growth[:top]]
+
+    def report(self, top=10):
+        lines = []
+        rss = rss_bytes()
+        if rss is not None:
+            lines.append(f"Resident memory: {rss / (1024 * 1024):.1f}MB")
+        if self.tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            lines.append(f"Traced: {current / (1024 * 1024):.1f}MB (peak {peak / (1024 * 1024):.1f}MB)")
+        for name, func in self.counters.items():
+            try:
+                lines.append(f"{name}: {func()}")
+            except Exception as e:
+                lines.append(f"{name}: unavailable ({e})")
+        for name, cache in self.caches.items():
+            stats = cache.stats()
+            lines.append(f"Cache {name}: {stats['entries']} entries, {stats['bytes'] / 1024:.0f}KB, "
+                         f"{stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evicted")
+        lines.append("Objects by type (count, change since last report):")
+        lines += [f"  {name}: {count} ({delta:+d})" for name, count, delta in self.object_counts(top)]
+        return lines
+
+    def trim_caches(self, fraction=0.5):
+        evicted = sum(cache.trim(fraction) for cache in self.caches.values())
+        gc.collect()
+        return evicted
@@ -0,0 +1,92 @@
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from yt_dlp import YoutubeDL
+
+# Only the fields the app actually reads are shipped back from the workers,
+# full info dicts are several hundred KB each and expensive to pickle.
+FORMAT_FIELDS = ('format_id', 'ext', 'height', 'vcodec', 'acodec',
+                 'filesize', 'filesize_approx', 'tbr', 'abr')
+
+DEFAULT_YDL_OPTS = {
+    'noplaylist': True,
+    'quiet': True,
+    'socket_timeout': 15,
+}
+
+# Per-process YoutubeDL instance, created once by the pool initializer so
+# extractors and HTTP handlers stay warm for the lifetime of the worker.
+_worker_ydl = None
+
+
+def _init_worker(ydl_opts):
+    global _worker_ydl
+    _worker_ydl = YoutubeDL(ydl_opts)
+
+
+def compact_record(info):
+    record = {
+        'id': info.get('id'),
+        'title': info.get('title'),
+        'duration': info.get('duration'),
+        'view_count': info.get('view_count'),
+        'formats': [[fmt.get(field) for field in FORMAT_FIELDS]
+                    for fmt in info.get('formats') or []],
+    }
+    return json.dumps(record, separators=(',', ':'))
+
+
+def load_record(data):
+    record = json.loads(data)
+    record['formats'] = [dict(zip(FORMAT_FIELDS, fmt)) for fmt in record['formats']]
+    return record
+
+
+def _extract_record(url):
+    try:
+        info = _worker_ydl.extract_info(url, download=False)
+        return url, compact_record(info), None
+    except Exception as e:
+        return url, None, str(e)
+
+
+class MetadataResolver:
+    def __init__(self, workers=None, ydl_opts=None):
+        self.workers = workers or os.cpu_count() or 2
+        self.ydl_opts = dict(DEFAULT_YDL_OPTS, **(ydl_opts or {}))
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.executor is None:
+                # Created from a background thread of a process already running Tk,
+                # VLC and the proxy; forking that can deadlock, spawn starts clean.
+                # Every spawned worker runs _init_worker, so no warm-up is needed.
+                self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                    mp_context=multiprocessing.get_context('spawn'),
+                                                    initializer=_init_worker,
+                                                    initargs=(self.ydl_opts,))
+        return self.executor
+
+    def resolve(self, url):
+        _, data, error = self.start().submit(_extract_record, url).result()
+        if error:
+            raise RuntimeError(error)
+        return load_record(data)
+
+    def resolve_many(self, urls):
+        # Yields (url, record, error) in completion order.
+        executor = self.start()
+        futures = [executor.submit(_extract_record, url) for url in urls]
+        for future in as_completed(futures):
+            url, data, error = future.result()
+            yield url, (load_record(data) if data else None), error
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
@@ -0,0 +1,283 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+# Fields the GUI shows for an item that live in the JSON 'data' column
+PROGRESS_FIELDS = ('progress', 'downloaded_bytes', 'total_bytes', 'speed', 'eta')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    id TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    options TEXT NOT NULL,
+    title TEXT,
+    status TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    data TEXT NOT NULL DEFAULT '{}',
+    completed_at REAL,
+    estimated_bytes INTEGER,
+    deadline REAL,
+    location TEXT
+);
+CREATE INDEX IF NOT EXISTS items_claim ON items (status, priority, created_at);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reservations (
+    id TEXT PRIMARY KEY,
+    worker TEXT NOT NULL,
+    volume TEXT NOT NULL,
+    outstanding INTEGER NOT NULL
+);
+"""
+
+
+# Columns added after the first release, created on queues made by older versions
+ADDED_COLUMNS = (('estimated_bytes', 'INTEGER'), ('deadline', 'REAL'), ('location', 'TEXT'))
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class QueueStore:
+    # Queue shared by several processes through one SQLite file. Workers claim
+    # items under a time-limited lease and keep it alive with heartbeats; items
+    # whose lease ran out are handed to the next worker that asks.
+    def __init__(self, path, lease_seconds=60, wal=True):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.wal = wal
+        self.local = threading.local()
+        self._connect().executescript(SCHEMA)
+        self._migrate()
+
+    def _connect(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            # WAL needs shared memory, which network filesystems don't provide
+            db.execute(f"PRAGMA journal_mode={'WAL' if self.wal else 'DELETE'}")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+
+    def _migrate(self):
+        with self._transaction() as db:
+            columns = {row['name'] for row in db.execute("PRAGMA table_info(items)")}
+            missing = [(name, kind) for name, kind in ADDED_COLUMNS if name not in columns]
+            for name, kind in missing:
+                db.execute(f"ALTER TABLE items ADD COLUMN {name} {kind}")
+            if not missing:
+                return
+            # Older queues kept the estimate in the JSON data, the rest in the options
+            assignments = ", ".join(f"{name}=?" for name, _ in missing)
+            for row in db.execute("SELECT id, options, data FROM items").fetchall():
+                data = json.loads(row['data'])
+                options = json.loads(row['options'])
+                values = {'estimated_bytes': data.pop('estimated_bytes', None),
+                          'deadline': options.get('deadline'),
+                          'location': options.get('location')}
+                db.execute(f"UPDATE items SET {assignments}, data=? WHERE id=?",
+                           (*(values[name] for name, _ in missing), json.dumps(data), row['id']))
+
+    class _Transaction:
+        def __init__(self, db):
+            self.db = db
+
+        def __enter__(self):
+            self.db.execute("BEGIN IMMEDIATE")
+            return self.db
+
+        def __exit__(self, exc_type, exc, tb):
+            self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+            return False
+
+    def _transaction(self):
+        return self._Transaction(self._connect())
+
+    def _row_to_item(self, row):
+        item = json.loads(row['data'])
+        item.update({
+            'id': row['id'],
+            'url': row['url'],
+            'options': json.loads(row['options']),
+            'title': row['title'],
+            'status': row['status'],
+            'worker': row['worker'],
+            'attempts': row['attempts'],
+            'estimated_bytes': row['estimated_bytes'],
+            'shared': True,
+        })
+        if row['completed_at']:
+            item['completed_at'] = row['completed_at']
+        return item
+
+    def add(self, download_id, url, options, title=None, estimated_bytes=None):
+        with self._transaction() as db:
+            db.execute("INSERT OR REPLACE INTO items (id, url, options, title, status, priority, created_at, data, "
+                       "estimated_bytes, deadline, location) VALUES (?, ?, ?, ?, 'queued', ?, ?, ?, ?, ?, ?)",
+                       (download_id, url, json.dumps(options), title, options.get('priority', 0),
+                        time.time(), json.dumps({'progress': 0}), estimated_bytes, options.get('deadline'),
+                        options.get('location')))
+        return download_id
+
+    def reclaim_expired(self, db=None, now=None):
+        now = now or time.time()
+        query = ("UPDATE items SET status='queued', worker=NULL, lease_expires=NULL "
+                 "WHERE status IN ('downloading', 'converting') AND lease_expires < ?")
+        if db is not None:
+            return db.execute(query, (now,)).rowcount
+        with self._transaction() as db:
+            return db.execute(query, (now,)).rowcount
+
+    def set_meta(self, key, value):
+        with self._transaction() as db:
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def get_meta(self, key, default=None):
+        row = self._connect().execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        return json.loads(row['value']) if row else default
+
+    def set_estimated_bytes(self, download_id, estimated_bytes):
+        with self._transaction() as db:
+            return db.execute("UPDATE items SET estimated_bytes=? WHERE id=?",
+                              (estimated_bytes, download_id)).rowcount > 0
+
+    def claim(self, worker_id, scheduler=None, exclude=(), exclude_locations=()):
+        # scheduler: anything with sql(now), e.g. scheduling.Scheduler; it picks
+        # the next item and may hold some back (off-peak). Without one items go
+        # by priority, then age. SQLite picks the row, so under the write lock
+        # only one row is read back however long the queue is. exclude: ids the
+        # worker just handed back, so it moves on to the next item instead;
+        # exclude_locations: destinations it can't write to right now.
+        now = time.time()
+        if scheduler is None:
+            where, where_params, order_by, order_params = "1", (), "priority DESC, created_at", ()
+        else:
+            where, where_params, order_by, order_params = scheduler.sql(now)
+        if exclude:
+            where += f" AND id NOT IN ({', '.join('?' for _ in exclude)})"
+            where_params = (*where_params, *exclude)
+        if exclude_locations:
+            where += f" AND (location IS NULL OR location NOT IN ({', '.join('?' for _ in exclude_locations)}))"
+            where_params = (*where_params, *exclude_locations)
+        with self._transaction() as db:
+            self.reclaim_expired(db, now)
+            row = db.execute(f"SELECT * FROM items WHERE status='queued' AND {where} "
+                             f"ORDER BY {order_by} LIMIT 1", (*where_params, *order_params)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE items SET status='downloading', worker=?, lease_expires=?, attempts=attempts+1 "
+                       "WHERE id=?", (worker_id, now + self.lease_seconds, row['id']))
+            row = db.execute("SELECT * FROM items WHERE id=?", (row['id'],)).fetchone()
+        return self._row_to_item(row)
+
+    def _update_owned(self, db, download_id, worker_id, assignments, values):
+        cursor = db.execute(f"UPDATE items SET {assignments} WHERE id=? AND worker=? "
+                            "AND status IN ('downloading', 'converting')",
+                            (*values, download_id, worker_id))
+        if cursor.rowcount == 0:
+            raise LeaseLost(download_id)
+
+    def heartbeat(self, download_id, worker_id, status='downloading', progress=None):
+        # Returns False when the lease was lost, e.g. the item was removed or reclaimed
+        try:
+            with self._transaction() as db:
+                row = db.execute("SELECT data FROM items WHERE id=?", (download_id,)).fetchone()
+                data = json.loads(row['data']) if row else {}
+                data.update({key: value for key, value in (progress or {}).items() if key in PROGRESS_FIELDS})
+                self._update_owned(db, download_id, worker_id, "status=?, lease_expires=?, data=?",
+                                   (status, time.time() + self.lease_seconds, json.dumps(data)))
+            return True
+        except LeaseLost:
+            return False
+
+    def complete(self, download_id, worker_id, file_path, details=None):
+        with self._transaction() as db:
+            row = db.execute("SELECT data FROM items WHERE id=?", (download_id,)).fetchone()
+            data = json.loads(row['data']) if row else {}
+            data.update(details or {})
+            data.update({'file_path': file_path, 'progress': 100})
+            self._update_owned(db, download_id, worker_id,
+                               "status='completed', lease_expires=NULL, completed_at=?, data=?",
+                               (time.time(), json.dumps(data)))
+
+    def fail(self, download_id, worker_id, error):
+        with self._transaction() as db:
+            row = db.execute("SELECT data FROM items WHERE id=?", (download_id,)).fetchone()
+            data = json.loads(row['data']) if row else {}
+            data['error'] = error
+            self._update_owned(db, download_id, worker_id, "status='error', lease_expires=NULL, data=?",
+                               (json.dumps(data),))
+
+    def release(self, download_id, worker_id, declined=False):
+        # Gives an item back to the queue, e.g. when a worker shuts down. A
+        # declined item was never started, so the claim doesn't count as an attempt.
+        assignments = "status='queued', worker=NULL, lease_expires=NULL"
+        if declined:
+            assignments += ", attempts=MAX(attempts-1, 0)"
+        try:
+            with self._transaction() as db:
+                self._update_owned(db, download_id, worker_id, assignments, ())
+        except LeaseLost:
+            pass
+
+    def reserve_space(self, download_id, worker_id, volume, needed, available):
+        # Admits a download on a volume only if everything the workers writing
+        # to it have reserved, plus needed, fits in available. Rows of items
+        # no longer leased to their worker (crashed, reclaimed) don't count.
+        with self._transaction() as db:
+            db.execute("DELETE FROM reservations WHERE NOT EXISTS (SELECT 1 FROM items WHERE items.id=reservations.id "
+                       "AND items.worker=reservations.worker AND items.status IN ('downloading', 'converting'))")
+            reserved = db.execute("SELECT COALESCE(SUM(outstanding), 0) FROM reservations "
+                                  "WHERE volume=? AND id!=?", (volume, download_id)).fetchone()[0]
+            if reserved + needed > available:
+                return False
+            db.execute("INSERT OR REPLACE INTO reservations (id, worker, volume, outstanding) VALUES (?, ?, ?, ?)",
+                       (download_id, worker_id, volume, needed))
+        return True
+
+    def update_reservation(self, download_id, outstanding):
+        with self._transaction() as db:
+            db.execute("UPDATE reservations SET outstanding=? WHERE id=?", (outstanding, download_id))
+
+    def release_space(self, download_id):
+        with self._transaction() as db:
+            db.execute("DELETE FROM reservations WHERE id=?", (download_id,))
+
+    def retry(self, download_id):
+        with self._transaction() as db:
+            return db.execute("UPDATE items SET status='queued', worker=NULL, lease_expires=NULL "
+                              "WHERE id=? AND status='error'", (download_id,)).rowcount > 0
+
+    def remove(self, download_id):
+        with self._transaction() as db:
+            return db.execute("DELETE FROM items WHERE id=?", (download_id,)).rowcount > 0
+
+    def items(self, statuses, limit=None):
+        placeholders = ", ".join("?" for _ in statuses)
+        query = f"SELECT * FROM items WHERE status IN ({placeholders}) ORDER BY created_at"
+        if limit:
+            query = f"SELECT * FROM ({query} DESC LIMIT {int(limit)}) ORDER BY created_at"
+        rows = self._connect().execute(query, tuple(statuses)).fetchall()
+        return [self._row_to_item(row) for row in rows]
+
+    def close(self):
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            db.close()
+            self.local.db = None
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
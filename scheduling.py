@@ -0,0 +1,120 @@
+import time
+
+PRIORITIES = {'low': -1, 'normal': 0, 'high': 1}
+
+
+def _estimated(item):
+    # Unknown sizes sort after everything we could estimate
+    size = item.get('estimated_bytes')
+    return size if size else float('inf')
+
+
+# SQL equivalents of _estimated and the deadline, for queue_store.claim
+SQL_SIZE = "NULLIF(estimated_bytes, 0)"
+SQL_DEADLINE = "NULLIF(deadline, 0)"
+
+
+class FifoPolicy:
+    name = 'FIFO'
+
+    def order(self, items, now):
+        return list(items)
+
+    def sql_order(self, now):
+        return "created_at", ()
+
+
+class ShortestJobFirstPolicy:
+    name = 'Shortest job first'
+
+    def order(self, items, now):
+        return sorted(items, key=_estimated)
+
+    def sql_order(self, now):
+        return f"{SQL_SIZE} IS NULL, {SQL_SIZE}, created_at", ()
+
+
+class PriorityDeadlinePolicy:
+    name = 'Priority / deadline'
+
+    def order(self, items, now):
+        def key(item):
+            options = item.get('options', {})
+            deadline = options.get('deadline') or float('inf')
+            # Anything about to miss its deadline jumps ahead of plain priority
+            overdue = deadline <= now + 3600
+            return (not overdue, -options.get('priority', 0), deadline, _estimated(item))
+        return sorted(items, key=key)
+
+    def sql_order(self, now):
+        return (f"CASE WHEN {SQL_DEADLINE} <= ? THEN 0 ELSE 1 END, priority DESC, "
+                f"{SQL_DEADLINE} IS NULL, {SQL_DEADLINE}, {SQL_SIZE} IS NULL, {SQL_SIZE}, created_at"), (now + 3600,)
+
+
+POLICIES = {policy.name: policy for policy in
+            (FifoPolicy(), ShortestJobFirstPolicy(), PriorityDeadlinePolicy())}
+
+
+def in_window(now, start_hour, end_hour):
+    hour = time.localtime(now).tm_hour
+    if start_hour <= end_hour:
+        return start_hour <= hour < end_hour
+    return hour >= start_hour or hour < end_hour
+
+
+class Scheduler:
+    @classmethod
+    def from_settings(cls, settings):
+        off_peak = None
+        if settings['off_peak_enabled']:
+            off_peak = {
+                'start_hour': settings['off_peak_start_hour'],
+                'end_hour': settings['off_peak_end_hour'],
+                'min_bytes': settings['off_peak_min_bytes'],
+            }
+        return cls(settings['scheduling_policy'], off_peak)
+
+    def __init__(self, policy_name='FIFO', off_peak=None):
+        self.policy = POLICIES.get(policy_name, POLICIES['FIFO'])
+        # off_peak: dict with start_hour, end_hour and min_bytes, or None
+        self.off_peak = off_peak
+
+    def set_policy(self, policy_name):
+        self.policy = POLICIES[policy_name]
+
+    def is_held(self, item, now):
+        if not self.off_peak or item.get('options', {}).get('deadline'):
+            return False
+        # Unknown sizes are held too: a freshly added item has no estimate yet
+        # and would otherwise slip past the window before it arrives
+        size = item.get('estimated_bytes')
+        if size is not None and size < self.off_peak['min_bytes']:
+            return False
+        return not in_window(now, self.off_peak['start_hour'], self.off_peak['end_hour'])
+
+    def order(self, items, now=None):
+        now = now or time.time()
+        queued = [item for item in items if item['status'] == 'queued']
+        ready = [item for item in queued if not self.is_held(item, now)]
+        return self.policy.order(ready, now)
+
+    def sql(self, now=None):
+        # order() as WHERE and ORDER BY clauses over the shared queue's columns,
+        # returns (where, where_params, order_by, order_params)
+        now = now or time.time()
+        where, params = "1", ()
+        if self.off_peak and not in_window(now, self.off_peak['start_hour'], self.off_peak['end_hour']):
+            # NULL sizes compare as unknown, so they stay held like in is_held
+            where, params = f"({SQL_DEADLINE} IS NOT NULL OR estimated_bytes < ?)", (self.off_peak['min_bytes'],)
+        return (where, params, *self.policy.sql_order(now))
+
+    def held_count(self, items, now=None):
+        now = now or time.time()
+        return sum(1 for item in items if item['status'] == 'queued' and self.is_held(item, now))
+
+    def describe(self):
+        text = self.policy.name
+        if self.off_peak:
+            text += (f", large items held until {self.off_peak['start_hour']:02d}:00-"
+                     f"{self.off_peak['end_hour']:02d}:00")
+        return text
@@ -0,0 +1,327 @@
+import json
+import os
+import re
+import shutil
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+
+CHUNK_SIZE = 256 * 1024
+
+
+def cache_key(video_id, format_id):
+    return re.sub(r'[^0-9A-Za-z_-]', '_', f"{video_id}-{format_id}")
+
+
+class SegmentCache:
+    # One sparse data file per video/format plus a JSON index of the byte
+    # ranges [start, end) that are actually present in it.
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entries = {}
+        self.lock = threading.RLock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_dir, key)
+        return base + '.bin', base + '.json'
+
+    def _entry(self, key):
+        if key not in self.entries:
+            data_path, index_path = self._paths(key)
+            entry = {'total_size': None, 'ranges': []}
+            if os.path.exists(index_path) and os.path.exists(data_path):
+                try:
+                    with open(index_path, 'r') as f:
+                        entry = json.load(f)
+                except (OSError, ValueError) as e:
+                    print(f"Discarding stream cache index {key}: {e}")
+            self.entries[key] = entry
+        return self.entries[key]
+
+    def has(self, key):
+        with self.lock:
+            return bool(self._entry(key)['ranges'])
+
+    def has_video(self, video_id):
+        prefix = cache_key(video_id, '')
+        return any(name.startswith(prefix) and name.endswith('.json')
+                   for name in os.listdir(self.cache_dir))
+
+    def total_size(self, key):
+        with self.lock:
+            return self._entry(key)['total_size']
+
+    def set_total_size(self, key, total_size):
+        with self.lock:
+            self._entry(key)['total_size'] = total_size
+
+    def write(self, key, offset, data):
+        if not data:
+            return
+        with self.lock:
+            data_path, _ = self._paths(key)
+            with open(data_path, 'r+b' if os.path.exists(data_path) else 'w+b') as f:
+                f.seek(offset)
+                f.write(data)
+            ranges = self._entry(key)['ranges'] + [[offset, offset + len(data)]]
+            ranges.sort()
+            merged = [ranges[0]]
+            for start, end in ranges[1:]:
+                if start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            self._entry(key)['ranges'] = merged
+
+    def read(self, key, start, end):
+        data_path, _ = self._paths(key)
+        with open(data_path, 'rb') as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def covered_until(self, key, position):
+        with self.lock:
+            for start, end in self._entry(key)['ranges']:
+                if start <= position < end:
+                    return end
+        return None
+
+    def next_cached(self, key, position):
+        with self.lock:
+            for start, _ in self._entry(key)['ranges']:
+                if start > position:
+                    return start
+        return None
+
+    def missing(self, key, total_size):
+        gaps = []
+        position = 0
+        with self.lock:
+            for start, end in self._entry(key)['ranges']:
+                if start > position:
+                    gaps.append((position, start))
+                position = max(position, end)
+        if position < total_size:
+            gaps.append((position, total_size))
+        return gaps
+
+    def flush(self, key):
+        with self.lock:
+            _, index_path = self._paths(key)
+            with open(index_path, 'w') as f:
+                json.dump(self._entry(key), f)
+
+    def take(self, key, dest):
+        # Hands the assembled file over to the download instead of copying it
+        with self.lock:
+            data_path, index_path = self._paths(key)
+            shutil.move(data_path, dest)
+            if os.path.exists(index_path):
+                os.remove(index_path)
+            self.entries.pop(key, None)
+
+    def discard(self, key):
+        with self.lock:
+            for path in self._paths(key):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.entries.pop(key, None)
+
+    def evict(self):
+        with self.lock:
+            files = []
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.bin'):
+                    path = os.path.join(self.cache_dir, name)
+                    stat = os.stat(path)
+                    # Sparse files: count allocated blocks where the platform reports them
+                    size = stat.st_blocks * 512 if hasattr(stat, 'st_blocks') else stat.st_size
+                    files.append((stat.st_mtime, size, name[:-4]))
+            used = sum(size for _, size, _ in files)
+            for _, size, key in sorted(files):
+                if used <= self.max_bytes:
+                    break
+                self.discard(key)
+                used -= size
+
+
+class CachingProxy:
+    def __init__(self, cache, host='127.0.0.1', port=0):
+        self.cache = cache
+        self.host = host
+        self.port = port
+        self.sources = {}
+        self.server = None
+
+    def start(self):
+        if self.server is None:
+            self.server = ThreadingHTTPServer((self.host, self.port), _make_handler(self))
+            self.server.daemon_threads = True
+            self.port = self.server.server_address[1]
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def register(self, video_id, format_id, url, headers=None, total_size=None):
+        key = cache_key(video_id, format_id)
+        self.sources[key] = (url, dict(headers or {}))
+        if total_size:
+            self.cache.set_total_size(key, total_size)
+        self.cache.evict()
+        self.start()
+        return f"http://{self.host}:{self.port}/{key}"
+
+    def total_size(self, key):
+        total = self.cache.total_size(key)
+        if total:
+            return total
+        url, headers = self.sources[key]
+        with requests.get(url, headers=dict(headers, Range='bytes=0-0'), stream=True, timeout=15) as response:
+            response.raise_for_status()
+            content_range = response.headers.get('Content-Range', '')
+            if '/' in content_range and not content_range.endswith('*'):
+                total = int(content_range.rsplit('/', 1)[1])
+            else:
+                total = int(response.headers['Content-Length'])
+        self.cache.set_total_size(key, total)
+        return total
+
+    def fetch_upstream(self, key, start, stop, write):
+        url, headers = self.sources[key]
+        position = start
+        with requests.get(url, headers=dict(headers, Range=f'bytes={start}-{stop - 1}'),
+                          stream=True, timeout=15) as response:
+            response.raise_for_status()
+            # Servers that ignore Range send the whole body from byte 0
+            skip = start if response.status_code == 200 else 0
+            for chunk in response.iter_content(CHUNK_SIZE):
+                if skip:
+                    dropped = min(skip, len(chunk))
+                    chunk = chunk[dropped:]
+                    skip -= dropped
+                chunk = chunk[:stop - position]
+                if not chunk:
+                    continue
+                self.cache.write(key, position, chunk)
+                position += len(chunk)
+                write(chunk)
+                if position >= stop:
+                    break
+        if position < stop:
+            raise IOError(f"Upstream ended at byte {position}, expected {stop}")
+        return position
+
+    def serve_range(self, key, start, stop, write):
+        position = start
+        try:
+            while position < stop:
+                cached_end = self.cache.covered_until(key, position)
+                if cached_end is not None:
+                    segment_end = min(stop, cached_end, position + CHUNK_SIZE)
+                    write(self.cache.read(key, position, segment_end))
+                    position = segment_end
+                    continue
+                next_start = self.cache.next_cached(key, position)
+                segment_end = min(stop, next_start) if next_start is not None else stop
+                position = self.fetch_upstream(key, position, segment_end, write)
+        finally:
+            self.cache.flush(key)
+
+    def fill(self, video_id, format_id, url, dest, headers=None, total_size=None, progress=None):
+        # Completes a cached entry with fresh upstream bytes and moves it to dest
+        key = cache_key(video_id, format_id)
+        self.sources[key] = (url, dict(headers or {}))
+        if total_size:
+            self.cache.set_total_size(key, total_size)
+        total = self.total_size(key)
+        downloaded = [total - sum(end - start for start, end in self.cache.missing(key, total))]
+
+        def count(chunk):
+            downloaded[0] += len(chunk)
+            if progress:
+                progress(downloaded[0], total)
+
+        try:
+            for start, stop in self.cache.missing(key, total):
+                self.fetch_upstream(key, start, stop, count)
+        finally:
+            self.cache.flush(key)
+        self.cache.take(key, dest)
+        return dest
+
+
+def _parse_range(header, total):
+    match = re.match(r'bytes=(\d*)-(\d*)$', header.strip())
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+    if not match.group(1):
+        start = max(0, total - int(match.group(2)))
+        return start, total
+    start = int(match.group(1))
+    stop = int(match.group(2)) + 1 if match.group(2) else total
+    return start, min(stop, total)
+
+
+def _make_handler(proxy):
+    class ProxyHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _prepare(self):
+            key = self.path.strip('/')
+            if key not in proxy.sources:
+                self.send_error(404)
+                return None
+            try:
+                total = proxy.total_size(key)
+            except Exception as e:
+                self.send_error(502, str(e))
+                return None
+            start, stop = 0, total
+            header = self.headers.get('Range')
+            if header:
+                parsed = _parse_range(header, total)
+                if parsed is None or parsed[0] >= total:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{total}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return None
+                start, stop = parsed
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{stop - 1}/{total}')
+            else:
+                self.send_response(200)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(stop - start))
+            self.end_headers()
+            return key, start, stop
+
+        def do_HEAD(self):
+            self._prepare()
+
+        def do_GET(self):
+            prepared = self._prepare()
+            if prepared is None:
+                return
+            key, start, stop = prepared
+            try:
+                proxy.serve_range(key, start, stop, self.wfile.write)
+            except (BrokenPipeError, ConnectionResetError):
+                # Player seeked or closed the stream, what was fetched stays cached
+                pass
+            except Exception as e:
+                print(f"Stream proxy error for {key}: {e}")
+                self.close_connection = True
+
+    return ProxyHandler
@@ -0,0 +1,178 @@
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from queue_store import QueueStore, LeaseLost
+from scheduling import Scheduler
+
+
+def _drain(path, worker_id, results):
+    # Runs in a separate process, claims until the queue is empty
+    store = QueueStore(path, lease_seconds=30)
+    claimed = []
+    while True:
+        item = store.claim(worker_id)
+        if item is None:
+            break
+        claimed.append(item['id'])
+        store.heartbeat(item['id'], worker_id, progress={'progress': 50})
+        store.complete(item['id'], worker_id, f"/tmp/{item['id']}")
+    results.put((worker_id, claimed))
+
+
+class QueueStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'queue.db')
+        self.store = QueueStore(self.path, lease_seconds=30)
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp.cleanup()
+
+    def add(self, count, **kwargs):
+        return [self.store.add(f"item-{i}", f"https://www.youtube.com/watch?v={i:011d}",
+                               {'format': 'video', 'location': '/tmp'}, **kwargs)
+                for i in range(count)]
+
+    def test_processes_never_claim_the_same_item(self):
+        ids = self.add(200)
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        workers = [context.Process(target=_drain, args=(self.path, f"worker-{n}", results)) for n in range(4)]
+        for worker in workers:
+            worker.start()
+        claimed = [results.get(timeout=60) for _ in workers]
+        for worker in workers:
+            worker.join(timeout=60)
+            self.assertEqual(worker.exitcode, 0)
+        all_claims = [download_id for _, ids_claimed in claimed for download_id in ids_claimed]
+        self.assertEqual(len(all_claims), len(set(all_claims)))
+        self.assertEqual(sorted(all_claims), sorted(ids))
+        self.assertEqual(len(self.store.items(['completed'])), len(ids))
+
+    def test_expired_lease_is_reclaimed(self):
+        store = QueueStore(self.path, lease_seconds=0.2)
+        self.add(1)
+        first = store.claim('worker-a')
+        self.assertIsNotNone(first)
+        self.assertIsNone(store.claim('worker-b'))
+        time.sleep(0.3)
+        second = store.claim('worker-b')
+        self.assertEqual(second['id'], first['id'])
+        self.assertEqual(second['attempts'], 2)
+        # The first worker notices it lost the item and can't finish it
+        self.assertFalse(store.heartbeat(first['id'], 'worker-a'))
+        with self.assertRaises(LeaseLost):
+            store.complete(first['id'], 'worker-a', '/tmp/out.mp4')
+        store.complete(second['id'], 'worker-b', '/tmp/out.mp4')
+        store.close()
+
+    def test_claim_follows_scheduler(self):
+        self.store.add('big', 'u1', {'location': '/tmp'}, estimated_bytes=900)
+        self.store.add('unknown', 'u2', {'location': '/tmp'})
+        self.store.add('small', 'u3', {'location': '/tmp'})
+        self.assertTrue(self.store.set_estimated_bytes('small', 100))
+        scheduler = Scheduler('Shortest job first')
+        order = [self.store.claim('w', scheduler)['id'] for _ in range(3)]
+        self.assertEqual(order, ['small', 'big', 'unknown'])
+
+    def test_claim_respects_off_peak_holds(self):
+        self.store.add('large', 'u1', {'location': '/tmp'}, estimated_bytes=10 ** 9)
+        # No estimate yet counts as possibly large
+        self.store.add('unknown', 'u2', {'location': '/tmp'})
+        self.store.add('small', 'u3', {'location': '/tmp'}, estimated_bytes=10)
+        hour = time.localtime().tm_hour
+        closed = Scheduler('FIFO', {'start_hour': (hour + 1) % 24, 'end_hour': (hour + 2) % 24,
+                                    'min_bytes': 10 ** 6})
+        self.assertEqual(self.store.claim('w', closed)['id'], 'small')
+        self.assertIsNone(self.store.claim('w', closed))
+        opened = Scheduler('FIFO', {'start_hour': hour, 'end_hour': (hour + 1) % 24, 'min_bytes': 10 ** 6})
+        self.assertEqual(self.store.claim('w', opened)['id'], 'large')
+
+    def test_claim_matches_scheduler_order(self):
+        # The SQL the store claims with has to pick what Scheduler.order would
+        now = time.time()
+        shapes = [(None, None, 0), (500, None, 0), (0, None, 1), (200, now + 600, 0),
+                  (900, now + 7200, 1), (100, None, -1), (None, now + 60, 0), (300, 0, 0)]
+        for i, (size, deadline, priority) in enumerate(shapes):
+            self.store.add(f"item-{i}", f"u{i}", {'location': '/tmp', 'deadline': deadline, 'priority': priority},
+                           estimated_bytes=size)
+        hour = time.localtime(now).tm_hour
+        closed = {'start_hour': (hour + 1) % 24, 'end_hour': (hour + 2) % 24, 'min_bytes': 400}
+        for policy in ('FIFO', 'Shortest job first', 'Priority / deadline'):
+            for off_peak in (None, closed):
+                scheduler = Scheduler(policy, off_peak)
+                expected = [item['id'] for item in scheduler.order(self.store.items(['queued']), now)]
+                claimed = []
+                while True:
+                    item = self.store.claim('w', scheduler)
+                    if item is None:
+                        break
+                    claimed.append(item['id'])
+                self.assertEqual(claimed, expected, (policy, off_peak))
+                for download_id in claimed:
+                    self.store.release(download_id, 'w')
+
+    def test_old_queue_is_migrated(self):
+        self.store.close()
+        path = os.path.join(self.tmp.name, 'old.db')
+        db = sqlite3.connect(path)
+        db.executescript("""
+            CREATE TABLE items (id TEXT PRIMARY KEY, url TEXT NOT NULL, options TEXT NOT NULL, title TEXT,
+                status TEXT NOT NULL, priority INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL,
+                worker TEXT, lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0,
+                data TEXT NOT NULL DEFAULT '{}', completed_at REAL);
+            INSERT INTO items (id, url, options, status, created_at, data)
+                VALUES ('old', 'u', '{"location": "/tmp", "deadline": 5.0}', 'queued', 1,
+                        '{"progress": 0, "estimated_bytes": 123}');
+        """)
+        db.commit()
+        db.close()
+        store = QueueStore(path)
+        item = store.claim('w', Scheduler('Shortest job first'))
+        self.assertEqual(item['estimated_bytes'], 123)
+        self.assertEqual(tuple(store._connect().execute("SELECT deadline, location FROM items").fetchone()),
+                         (5.0, '/tmp'))
+        store.close()
+
+    def test_declined_item_is_skipped_and_not_counted(self):
+        self.add(2)
+        first = self.store.claim('w')
+        self.store.release(first['id'], 'w', declined=True)
+        second = self.store.claim('w', exclude=[first['id']])
+        self.assertNotEqual(second['id'], first['id'])
+        self.assertIsNone(self.store.claim('w', exclude=[first['id']]))
+        self.assertEqual(self.store.claim('w')['attempts'], 1)
+
+    def test_claim_skips_busy_locations(self):
+        self.store.add('busy', 'u1', {'location': '/mnt/a'})
+        self.store.add('free', 'u2', {'location': '/mnt/b'})
+        self.assertEqual(self.store.claim('w', exclude_locations=['/mnt/a'])['id'], 'free')
+        self.assertIsNone(self.store.claim('w', exclude_locations=['/mnt/a']))
+        self.assertEqual(self.store.claim('w')['id'], 'busy')
+
+    def test_space_reservations_are_shared(self):
+        self.add(3)
+        a, b, c = (self.store.claim(worker) for worker in ('worker-a', 'worker-b', 'worker-c'))
+        self.assertTrue(self.store.reserve_space(a['id'], 'worker-a', 'host:1', 600, 1000))
+        # Another worker on the same volume sees what the first one holds
+        self.assertFalse(self.store.reserve_space(b['id'], 'worker-b', 'host:1', 600, 1000))
+        self.assertTrue(self.store.reserve_space(b['id'], 'worker-b', 'host:2', 600, 1000))
+        self.store.update_reservation(a['id'], 100)
+        self.assertTrue(self.store.reserve_space(c['id'], 'worker-c', 'host:1', 600, 1000))
+        self.store.release_space(c['id'])
+        # A reservation whose worker lost the item stops counting
+        self.store.release(a['id'], 'worker-a')
+        self.assertTrue(self.store.reserve_space(c['id'], 'worker-c', 'host:1', 900, 1000))
+
+    def test_meta_round_trip(self):
+        self.assertIsNone(self.store.get_meta('policy'))
+        self.store.set_meta('policy', 'Shortest job first')
+        self.assertEqual(self.store.get_meta('policy'), 'Shortest job first')
+
+
+if __name__ == "__main__":
+    unittest.main()
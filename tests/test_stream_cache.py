@@ -0,0 +1,102 @@
+import os
+import re
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from stream_cache import SegmentCache, CachingProxy, cache_key
+
+PAYLOAD = bytes(range(256)) * 4096  # 1 MiB
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    # Minimal upstream that honours single Range requests, like googlevideo does
+    protocol_version = 'HTTP/1.1'
+    requests_served = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        start, stop = 0, len(PAYLOAD)
+        header = self.headers.get('Range')
+        if header:
+            match = re.match(r'bytes=(\d+)-(\d*)$', header)
+            start = int(match.group(1))
+            stop = min(int(match.group(2)) + 1 if match.group(2) else stop, len(PAYLOAD))
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{stop - 1}/{len(PAYLOAD)}')
+        else:
+            self.send_response(200)
+        self.requests_served.append((start, stop))
+        self.send_header('Content-Length', str(stop - start))
+        self.end_headers()
+        self.wfile.write(PAYLOAD[start:stop])
+
+
+class CachingProxyTest(unittest.TestCase):
+    def setUp(self):
+        RangeHandler.requests_served = []
+        self.upstream = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        threading.Thread(target=self.upstream.serve_forever, daemon=True).start()
+        self.upstream_url = f"http://127.0.0.1:{self.upstream.server_address[1]}/video"
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = SegmentCache(os.path.join(self.tmp.name, 'cache'), max_bytes=64 * 1024 * 1024)
+        self.proxy = CachingProxy(self.cache)
+
+    def tearDown(self):
+        self.proxy.stop()
+        self.upstream.shutdown()
+        self.upstream.server_close()
+        self.tmp.cleanup()
+
+    def upstream_bytes(self):
+        return sum(stop - start for start, stop in RangeHandler.requests_served)
+
+    def test_range_requests_are_served_and_cached(self):
+        url = self.proxy.register('abc', '140', self.upstream_url, total_size=len(PAYLOAD))
+        response = requests.get(url, headers={'Range': 'bytes=1000-99999'}, timeout=10)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.headers['Content-Range'], f'bytes 1000-99999/{len(PAYLOAD)}')
+        self.assertEqual(response.content, PAYLOAD[1000:100000])
+        fetched = self.upstream_bytes()
+
+        # The same range again comes from the cache
+        response = requests.get(url, headers={'Range': 'bytes=2000-50000'}, timeout=10)
+        self.assertEqual(response.content, PAYLOAD[2000:50001])
+        self.assertEqual(self.upstream_bytes(), fetched)
+
+    def test_full_request_only_fetches_gaps(self):
+        url = self.proxy.register('abc', '140', self.upstream_url)
+        requests.get(url, headers={'Range': 'bytes=0-4095'}, timeout=10)
+        RangeHandler.requests_served = []
+        response = requests.get(url, timeout=10)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, PAYLOAD)
+        self.assertEqual(self.upstream_bytes(), len(PAYLOAD) - 4096)
+
+    def test_unsatisfiable_range(self):
+        url = self.proxy.register('abc', '140', self.upstream_url, total_size=len(PAYLOAD))
+        response = requests.get(url, headers={'Range': f'bytes={len(PAYLOAD)}-'}, timeout=10)
+        self.assertEqual(response.status_code, 416)
+
+    def test_fill_completes_preview_into_download(self):
+        url = self.proxy.register('abc', '251', self.upstream_url, total_size=len(PAYLOAD))
+        requests.get(url, headers={'Range': 'bytes=500000-600000'}, timeout=10)
+        RangeHandler.requests_served = []
+        dest = os.path.join(self.tmp.name, 'out.webm')
+        progress = []
+        self.proxy.fill('abc', '251', self.upstream_url, dest, total_size=len(PAYLOAD),
+                        progress=lambda done, total: progress.append((done, total)))
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), PAYLOAD)
+        self.assertEqual(self.upstream_bytes(), len(PAYLOAD) - 100001)
+        self.assertEqual(progress[-1], (len(PAYLOAD), len(PAYLOAD)))
+        # The entry moved to the download, nothing is left behind in the cache
+        self.assertFalse(self.cache.has(cache_key('abc', '251')))
+        self.assertFalse(self.cache.has_video('abc'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,255 @@
+import argparse
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import youtube_urls
+import downloader
+import integrity
+import write_path
+from audio import Transcoder
+from config import load_settings
+from queue_store import QueueStore, default_worker_id
+from disk_space import DiskReservations, space_factor
+from cancellation import CancelRegistry
+from scheduling import Scheduler, POLICIES
+from io_scheduler import IOScheduler
+
+# Headless download worker for the shared queue. Start any number of these,
+# on this machine or others, against the same shared_queue_path:
+#   python worker.py --slots 3
+
+
+class StoreReservations:
+    # Shared side of DiskReservations: every worker on this host admits
+    # against the same totals, device numbers only mean something per host
+    def __init__(self, store, worker_id):
+        self.store = store
+        self.worker_id = worker_id
+        self.host = socket.gethostname()
+
+    def reserve(self, download_id, device, needed, available):
+        return self.store.reserve_space(download_id, self.worker_id, f"{self.host}:{device}", needed, available)
+
+    def update(self, download_id, outstanding):
+        self.store.update_reservation(download_id, outstanding)
+
+    def release(self, download_id):
+        self.store.release_space(download_id)
+
+
+class LeaseKeeper:
+    def __init__(self, store, download_id, worker_id, token, on_beat=None):
+        self.store = store
+        self.download_id = download_id
+        self.worker_id = worker_id
+        self.token = token
+        self.on_beat = on_beat
+        self.status = 'downloading'
+        self.progress = {}
+        self.lost = threading.Event()
+        self.done = threading.Event()
+        # Heartbeats run on their own thread so long merges and conversions,
+        # which report no progress, don't let the lease run out
+        self.thread = threading.Thread(target=self._beat, daemon=True)
+        self.thread.start()
+
+    def _beat(self):
+        while not self.done.wait(self.store.lease_seconds / 3):
+            if not self.store.heartbeat(self.download_id, self.worker_id, self.status, self.progress):
+                self.lost.set()
+                # Someone else owns the item now, stop writing to it right away
+                self.token.cancel('lease lost')
+                return
+            if self.on_beat is not None:
+                try:
+                    self.on_beat()
+                except sqlite3.Error as e:
+                    print(f"Could not update {self.download_id} in the shared queue: {e}")
+
+    def on_progress(self, data):
+        if data['status'] == 'downloading':
+            total = data.get('total_bytes') or data.get('total_bytes_estimate') or 0
+            downloaded = data.get('downloaded_bytes', 0)
+            self.progress = {
+                'progress': int(downloaded / total * 100) if total else 0,
+                'downloaded_bytes': downloaded,
+                'total_bytes': total,
+                'speed': data.get('speed'),
+                'eta': data.get('eta'),
+            }
+        self.token.raise_if_cancelled()
+
+    def stop(self):
+        self.done.set()
+
+
+class Worker:
+    def __init__(self, store, settings, worker_id, slots):
+        self.store = store
+        self.settings = settings
+        self.worker_id = worker_id
+        self.slots = slots
+        self.stopping = threading.Event()
+        self.scheduler = Scheduler.from_settings(settings)
+        self.cancellation = CancelRegistry()
+        self.transcoder = Transcoder(workers=settings['transcode_workers'] or None)
+        self.disk_reservations = DiskReservations(margin_bytes=settings['disk_space_margin'],
+                                                  unknown_bytes=settings['disk_space_unknown_size'],
+                                                  shared=StoreReservations(store, worker_id))
+        # {download_id: monotonic time} of items handed back, skipped by claims until then
+        self.declined = {}
+        # Destinations whose disk had no free writer slot, skipped while that lasts
+        self.busy_locations = set()
+        self.declined_lock = threading.Lock()
+        self.io = IOScheduler(max_writers=settings['io_writers_per_device'],
+                              max_merges=settings['io_merges_per_device'],
+                              device_limits=settings['io_device_limits'],
+                              window=settings['io_throughput_window'])
+
+    def run(self):
+        threads = [threading.Thread(target=self._slot_loop, daemon=True) for _ in range(self.slots)]
+        for thread in threads:
+            thread.start()
+        print(f"Worker {self.worker_id} running with {self.slots} slots on {self.store.path}")
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(timeout=1)
+        except KeyboardInterrupt:
+            print("Stopping, in-flight items go back to the queue")
+            self.stopping.set()
+            self.cancellation.cancel_all('shutdown')
+            for thread in threads:
+                thread.join()
+        self.transcoder.shutdown()
+
+    def _slot_loop(self):
+        while not self.stopping.is_set():
+            try:
+                # The GUI publishes its policy, deadlines and sizes live in the items
+                policy = self.store.get_meta('policy')
+                if policy in POLICIES:
+                    self.scheduler.set_policy(policy)
+                item = self.store.claim(self.worker_id, self.scheduler, self.skipped(), self.saturated())
+            except sqlite3.Error as e:
+                # Lock timeouts and similar are transient, a dead slot is not
+                print(f"Could not claim from the shared queue: {e}")
+                self.stopping.wait(self.settings['shared_queue_poll'] * 2)
+                continue
+            if item is None:
+                self.stopping.wait(self.settings['shared_queue_poll'])
+                continue
+            try:
+                self.process(item)
+            except Exception as e:
+                print(f"Slot error while handling {item['url']}: {e}")
+                self.stopping.wait(self.settings['shared_queue_poll'])
+
+    def skipped(self):
+        now = time.monotonic()
+        with self.declined_lock:
+            for download_id in [key for key, until in self.declined.items() if until <= now]:
+                del self.declined[download_id]
+            return list(self.declined)
+
+    def saturated(self):
+        with self.declined_lock:
+            self.busy_locations = {location for location in self.busy_locations
+                                   if not self.io.can_start(location)}
+            return list(self.busy_locations)
+
+    def decline(self, download_id, seconds=0):
+        # Hands an item back without counting it as an attempt; with seconds
+        # the next claims pass over it instead of picking it straight up again
+        if seconds:
+            with self.declined_lock:
+                self.declined[download_id] = time.monotonic() + seconds
+        self.store.release(download_id, self.worker_id, declined=True)
+
+    def process(self, item):
+        download_id = item['id']
+        options = item['options']
+        ffmpeg_available = shutil.which("ffmpeg") is not None
+        if not self.io.can_start(options['location']):
+            # Leaves the location to workers or slots writing to other disks
+            with self.declined_lock:
+                self.busy_locations.add(options['location'])
+            self.decline(download_id)
+            return
+        if not self.disk_reservations.try_reserve(download_id, options['location'], item.get('estimated_bytes'),
+                                                  space_factor(options, ffmpeg_available)):
+            # Another worker with room on its volume may take it meanwhile
+            print(f"Not enough disk space for {item['url']}, returning it to the queue")
+            self.decline(download_id, self.settings['shared_queue_poll'] * 5)
+            return
+        self.io.start_writing(download_id, options['location'])
+        token = self.cancellation.create(download_id)
+        keeper = LeaseKeeper(self.store, download_id, self.worker_id, token,
+                             lambda: self.disk_reservations.publish(download_id))
+        merge_gate = self.io.merge_gate(options['location'], token)
+        try:
+            location = options['location']
+            staged = self.settings['staged_writes']
+            write_dir = write_path.staging_dir(location) if staged else location
+            hasher = integrity.StreamingHasher()
+            progress_hooks = [hasher.on_progress, keeper.on_progress,
+                              lambda d: self.disk_reservations.record_written(download_id, d),
+                              lambda d: self.io.record_progress(download_id, d)]
+            if self.settings['preallocate']:
+                preallocator = write_path.Preallocator(
+                    lambda path, size: self.disk_reservations.record_preallocated(download_id, path, size))
+                progress_hooks.insert(0, preallocator.on_progress)
+            ydl_opts = downloader.build_ydl_opts(options, write_dir, progress_hooks,
+                                                 self.settings, ffmpeg_available)
+            ydl_opts['postprocessor_hooks'] = [merge_gate.on_postprocessor]
+            output_file, _ = downloader.run_ydl(youtube_urls.canonicalize(item['url']), ydl_opts, token=token)
+            if downloader.needs_transcode(options, ffmpeg_available):
+                keeper.status = 'converting'
+                self.io.finish_writing(download_id)
+                with self.io.merge_slot(location, token):
+                    output_file = self.transcoder.submit(output_file, 'mp3', self.settings['mp3_bitrate'],
+                                                         token).result()
+            output_file, details = downloader.finish_download(output_file, location, hasher,
+                                                              options['format'], staged)
+            keeper.stop()
+            self.store.complete(download_id, self.worker_id, output_file, details)
+            print(f"Completed {item['url']} -> {output_file}")
+        except Exception as e:
+            keeper.stop()
+            if keeper.lost.is_set():
+                print(f"Lease lost for {item['url']}, dropping it")
+            elif self.stopping.is_set():
+                self.store.release(download_id, self.worker_id)
+            else:
+                print(f"Download failed for {item['url']}: {e}")
+                try:
+                    self.store.fail(download_id, self.worker_id, str(e))
+                except Exception as lease_error:
+                    print(f"Could not record failure: {lease_error}")
+        finally:
+            merge_gate.close()
+            self.disk_reservations.release(download_id)
+            self.io.finish_writing(download_id)
+            self.cancellation.discard(download_id, token)
+
+
+def main():
+    settings = load_settings()
+    parser = argparse.ArgumentParser(description="Download worker for the shared queue")
+    parser.add_argument('--store', default=settings['shared_queue_path'],
+                        help="path of the shared SQLite queue (default: shared_queue_path setting)")
+    parser.add_argument('--slots', type=int, default=settings['max_concurrent_downloads'],
+                        help="concurrent downloads in this process")
+    parser.add_argument('--worker-id', default=default_worker_id())
+    args = parser.parse_args()
+    if not args.store:
+        parser.error("no shared queue configured, pass --store or set shared_queue_path")
+    store = QueueStore(args.store, lease_seconds=settings['shared_queue_lease'],
+                       wal=settings['shared_queue_wal'])
+    Worker(store, settings, args.worker_id, args.slots).run()
+
+
+if __name__ == "__main__":
+    main()
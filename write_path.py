@@ -0,0 +1,137 @@
+import ctypes
+import ctypes.util
+import glob
+import os
+import threading
+
+STAGING_DIR_NAME = '.ytdl-staging'
+FALLOC_FL_KEEP_SIZE = 0x01
+
+_libc = None
+if os.name == 'posix':
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+    except (OSError, AttributeError):
+        _libc = None
+
+
+def staging_dir(location):
+    # Kept inside the destination so the final rename never crosses filesystems
+    path = os.path.join(location, STAGING_DIR_NAME)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def preallocate(path, size):
+    # Reserve contiguous extents without changing the visible file size, so the
+    # downloader can keep appending to the .part file as usual.
+    if _libc is None or not size:
+        return False
+    try:
+        fd = os.open(path, os.O_WRONLY)
+    except OSError:
+        return False
+    try:
+        return _libc.fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, int(size)) == 0
+    finally:
+        os.close(fd)
+
+
+def build_write_opts(buffer_size=None, http_chunk_size=None):
+    opts = {}
+    if buffer_size:
+        opts['buffersize'] = int(buffer_size)
+        opts['noresizebuffer'] = True
+    if http_chunk_size:
+        opts['http_chunk_size'] = int(http_chunk_size)
+    return opts
+
+
+def fsync_path(path, directory=False):
+    if directory and os.name != 'posix':
+        return
+    fd = os.open(path, os.O_RDONLY if directory else os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def candidate_paths(location, name):
+    # Title.ext, Title (1).ext, Title (2).ext, ...
+    base, ext = os.path.splitext(name)
+    yield os.path.join(location, name)
+    number = 1
+    while True:
+        yield os.path.join(location, f"{base} ({number}){ext}")
+        number += 1
+
+
+def finalize(staged_path, location):
+    # Staged files never collide in the destination while downloading, so an
+    # existing file with the same name (same title, or a re-queued video) is
+    # kept and the new one gets a numbered name instead.
+    fsync_path(staged_path)
+    for final_path in candidate_paths(location, os.path.basename(staged_path)):
+        try:
+            # link() refuses to replace an existing file, which also covers
+            # other workers finalizing into the same folder at the same time
+            os.link(staged_path, final_path)
+        except FileExistsError:
+            continue
+        except OSError:
+            # Filesystems without hard links
+            if os.path.exists(final_path):
+                continue
+            os.replace(staged_path, final_path)
+            break
+        os.remove(staged_path)
+        break
+    fsync_path(location, directory=True)
+    return final_path
+
+
+def remove_partials(paths):
+    # Leftovers of a removed download: .part files with their fragments and
+    # .ytdl resume state, and finished format pieces still waiting in staging.
+    # Preallocated blocks of a .part file are only returned once it is deleted.
+    removed = 0
+    for path in paths:
+        if path.endswith('.part'):
+            targets = glob.glob(glob.escape(path) + '*') + [path[:-len('.part')] + '.ytdl']
+        elif os.path.basename(os.path.dirname(path)) == STAGING_DIR_NAME:
+            targets = [path, path + '.ytdl']
+        else:
+            continue
+        for target in targets:
+            try:
+                os.remove(target)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Could not remove partial file {target}: {e}")
+    return removed
+
+
+class Preallocator:
+    # on_allocated(path, size) is called for every file that was preallocated
+    def __init__(self, on_allocated=None):
+        self.on_allocated = on_allocated
+        self.seen = set()
+        self.lock = threading.Lock()
+
+    def on_progress(self, data):
+        if data.get('status') != 'downloading':
+            return
+        path = data.get('tmpfilename')
+        total = data.get('total_bytes') or data.get('total_bytes_estimate')
+        if not path or not total:
+            return
+        with self.lock:
+            if path in self.seen:
+                return
+            self.seen.add(path)
+        if preallocate(path, total) and self.on_allocated:
+            self.on_allocated(path, int(total))
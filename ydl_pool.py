@@ -0,0 +1,79 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from yt_dlp import YoutubeDL
+
+
+def options_key(ydl_opts):
+    # Hooks and other callables can't be shared between callers, so only plain
+    # option sets are poolable; repr() keeps the key stable for anything else.
+    return json.dumps({k: v for k, v in ydl_opts.items() if v is not None},
+                      sort_keys=True, default=repr)
+
+
+class YoutubeDLPool:
+    def __init__(self, max_idle_per_key=4, max_uses=100, max_age=900):
+        self.max_idle_per_key = max_idle_per_key
+        self.max_uses = max_uses
+        self.max_age = max_age
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def _expired(self, entry):
+        _, created, uses = entry
+        return uses >= self.max_uses or time.time() - created >= self.max_age
+
+    def _close(self, ydl):
+        try:
+            ydl.__exit__(None, None, None)
+        except Exception as e:
+            print(f"Error closing YoutubeDL instance: {e}")
+
+    def checkout(self, ydl_opts):
+        key = options_key(ydl_opts)
+        stale = []
+        entry = None
+        with self.lock:
+            entries = self.idle.get(key, [])
+            while entries:
+                candidate = entries.pop()
+                if self._expired(candidate):
+                    stale.append(candidate[0])
+                else:
+                    entry = candidate
+                    break
+        for ydl in stale:
+            self._close(ydl)
+        if entry is None:
+            entry = (YoutubeDL(dict(ydl_opts)), time.time(), 0)
+        return key, entry
+
+    def checkin(self, key, entry, healthy=True):
+        ydl, created, uses = entry
+        entry = (ydl, created, uses + 1)
+        if healthy and not self._expired(entry):
+            with self.lock:
+                entries = self.idle.setdefault(key, [])
+                if len(entries) < self.max_idle_per_key:
+                    entries.append(entry)
+                    return
+        self._close(ydl)
+
+    @contextmanager
+    def session(self, ydl_opts):
+        key, entry = self.checkout(ydl_opts)
+        healthy = False
+        try:
+            yield entry[0]
+            healthy = True
+        finally:
+            # Instances that raised may hold half-read connections, drop them
+            self.checkin(key, entry, healthy)
+
+    def clear(self):
+        with self.lock:
+            entries = [entry for entries in self.idle.values() for entry in entries]
+            self.idle = {}
+        for ydl, _, _ in entries:
+            self._close(ydl)
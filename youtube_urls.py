@@ -0,0 +1,100 @@
+import re
+import time
+
+# One pattern for every URL shape we accept, so each URL is scanned once:
+#   youtu.be/ID, youtube.com/watch?...v=ID, /shorts/ID, /live/ID, /embed/ID,
+#   /v/ID, /e/ID, /playlist?list=ID and /embed/videoseries?list=ID on www, m,
+#   music and nocookie hosts.
+# A bare 11 character ID also matches, callers have to ask for it with
+# allow_bare since any 11 letter word looks like one.
+_URL_RE = re.compile(r'''
+    \s*(?:https?://)?(?:(?:www|m|music|gaming)\.)?
+    (?:
+        youtu\.be/(?P<short>[0-9A-Za-z_-]{11})
+      | youtube(?:-nocookie)?\.com/
+        (?:
+            embed/videoseries
+          | (?:shorts|live|embed|v|e)/(?P<path>[0-9A-Za-z_-]{11})
+          | watch/?\?(?:[^#\s]*?&)?v=(?P<query>[0-9A-Za-z_-]{11})
+          | playlist\?(?:[^#\s]*?&)?list=(?P<playlist>[0-9A-Za-z_-]+)
+        )
+      | (?P<bare>[0-9A-Za-z_-]{11})\s*$
+    )
+    (?![0-9A-Za-z_-])
+    (?:[^#\s]*?[?&]list=(?P<list>[0-9A-Za-z_-]+))?
+''', re.VERBOSE | re.IGNORECASE)
+
+WATCH_URL = "https://www.youtube.com/watch?v={}"
+PLAYLIST_URL = "https://www.youtube.com/playlist?list={}"
+
+
+def parse(url, allow_bare=False):
+    # Returns (video_id, playlist_id), either may be None
+    match = _URL_RE.match(url)
+    if not match or (match.group('bare') and not allow_bare):
+        return None, None
+    video_id = match.group('query') or match.group('short') or match.group('path') or match.group('bare')
+    return video_id, match.group('list') or match.group('playlist')
+
+
+def extract_video_id(url, allow_bare=False):
+    return parse(url, allow_bare)[0]
+
+
+def canonicalize(url, allow_bare=False):
+    video_id, playlist_id = parse(url, allow_bare)
+    if video_id:
+        return WATCH_URL.format(video_id)
+    if playlist_id:
+        return PLAYLIST_URL.format(playlist_id)
+    return url.strip()
+
+
+def normalize_many(urls, allow_bare=False):
+    # Returns (unique canonical video URLs in input order, unique playlist URLs,
+    # inputs that weren't YouTube URLs). Playlists are kept apart because a
+    # queue entry is a single video, callers decide whether to expand them.
+    seen_raw = set()
+    canonical = {}
+    playlists = {}
+    invalid = []
+    for url in urls:
+        if url in seen_raw:
+            continue
+        seen_raw.add(url)
+        video_id, playlist_id = parse(url, allow_bare)
+        if video_id:
+            canonical.setdefault(WATCH_URL.format(video_id), None)
+        elif playlist_id:
+            playlists.setdefault(PLAYLIST_URL.format(playlist_id), None)
+        elif url.strip():
+            invalid.append(url)
+    return list(canonical), list(playlists), invalid
+
+
+def benchmark(count=50000):
+    shapes = [
+        "https://www.youtube.com/watch?v={}",
+        "https://m.youtube.com/watch?feature=share&v={}&t=42s",
+        "https://music.youtube.com/watch?v={}&list=RDAMVM{}",
+        "https://youtu.be/{}?si=abcdef",
+        "https://www.youtube.com/shorts/{}",
+        "https://www.youtube.com/live/{}?feature=share",
+        "https://www.youtube-nocookie.com/embed/{}",
+    ]
+    urls = []
+    for i in range(count):
+        video_id = f"{i:011d}"[-11:]
+        urls.append(shapes[i % len(shapes)].format(video_id, video_id))
+    # Pasted lists are full of repeats, include some
+    urls += urls[:count // 10]
+    start = time.perf_counter()
+    canonical, _, invalid = normalize_many(urls)
+    elapsed = time.perf_counter() - start
+    print(f"normalize_many: {len(urls)} URLs -> {len(canonical)} unique, {len(invalid)} invalid "
+          f"in {elapsed * 1000:.1f} ms ({len(urls) / elapsed:,.0f} URLs/s)")
+    return elapsed
+
+
+if __name__ == "__main__":
+    benchmark()